@@ -2,10 +2,15 @@
 
 from __future__ import annotations
 from datetime import datetime, timedelta
-from typing import List
+import json
+import os
+from typing import Any, List
 
 DEFAULT_SKIP_DAYS = [5, 6]  # Saturday and Sunday
 
+# Folder next to the apps used for persisting app data across restarts
+STORAGE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), ".storage")
+
 def get_skip_dates(skip_dates) -> List[datetime]:
     """Get list of dates on which there are no events."""
     dates = set()  # Start as set to avoid duplicates
@@ -52,3 +57,26 @@ def round_float(value: float | None, decimal_places: int) -> float | None:
         return int(value)
 
     return round(value, decimal_places)
+
+
+def get_storage_path(filename: str) -> str:
+    """Return the path of filename inside the storage folder, creating the folder if needed."""
+    os.makedirs(STORAGE_DIR, exist_ok=True)
+    return os.path.join(STORAGE_DIR, filename)
+
+
+def load_json(path: str, default: Any = None) -> Any:
+    """Load json data from path, returns default if the file is missing or invalid."""
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def save_json(path: str, data: Any) -> None:
+    """Atomically write json data to path."""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(temp_path, path)
@@ -0,0 +1,68 @@
+"""Streaming extraction of MyPoints offer links from mail html.
+
+The html is tokenized in chunks with HTMLParser and only the offer links are
+kept, so no document tree is built and memory does not grow with the size of
+the mail.
+"""
+from html.parser import HTMLParser
+import urllib.parse
+
+GMX_PREFIX = "https://deref-gmx.com/mail/client/Xd-wFjnrIUA/dereferrer/?redirectUrl="
+OFFER_LINK = "mypoints.com/?cmd=oh-offer-click"
+
+CHUNK_SIZE = 64 * 1024
+
+
+def fix_link(link: str) -> str:
+    """Remove the GMX redirect and non-ascii characters and unquote the link."""
+    if link.find(GMX_PREFIX) != -1:
+        link = link[len(GMX_PREFIX) :]
+
+    # https://stackoverflow.com/questions/8689795/how-can-i-remove-non-ascii-characters-but-leave-periods-and-spaces-using-python
+    link = link.encode("ascii", errors="ignore").decode()
+    return urllib.parse.unquote(link)
+
+
+def valid_link(link: str) -> bool:
+    if not link:
+        return False
+    return link.find(OFFER_LINK) != -1
+
+    # if link.find("account-settings#close-account") != -1:
+    #     return False
+    # if link.find("mp-ac-email-unsub") != -1:
+    #     return False
+    # if link.find("mp-ac-email-client-optout") != -1:
+    #     return False
+    # if link.find("mypoints.com/account-statement") != -1:
+    #     return False
+
+
+class OfferLinkParser(HTMLParser):
+    """Collects the unique offer links of the anchors in document order."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.links = {}
+
+    def handle_starttag(self, tag, attrs):
+        if tag != "a":
+            return
+
+        for name, value in attrs:
+            if name != "href" or not value:
+                continue
+
+            # Unwrap first so that redirected offer links are recognized
+            link = fix_link(value)
+            if valid_link(link):
+                self.links[link] = None
+
+
+def extract_links(html: str, chunk_size: int = CHUNK_SIZE) -> list:
+    """Return the unique offer links in html."""
+    parser = OfferLinkParser()
+    for start in range(0, len(html), chunk_size):
+        parser.feed(html[start : start + chunk_size])
+    parser.close()
+    return list(parser.links)
@@ -0,0 +1,118 @@
+"""Benchmark LinkExtractor against the previous BeautifulSoup link extraction.
+
+Usage:
+    python LinkExtractorBenchmark.py [corpus folder] [repeat]
+
+The corpus folder contains saved mails (.eml files). Without a corpus a large
+synthetic promotional mail is used. For each extraction path the time per mail
+and the peak traced memory are reported and the extracted links are compared.
+"""
+import email
+import email.policy
+import glob
+import os
+import sys
+import time
+import tracemalloc
+
+import LinkExtractor
+
+try:
+    from bs4 import BeautifulSoup
+except ImportError:
+    BeautifulSoup = None
+
+DEFAULT_REPEAT = 5
+
+
+def load_corpus(folder):
+    """Return the html bodies of the saved mails in folder."""
+    bodies = []
+    for path in sorted(glob.glob(os.path.join(folder, "*.eml"))):
+        with open(path, "rb") as f:
+            message = email.message_from_binary_file(f, policy=email.policy.default)
+
+        part = message.get_body(preferencelist=("html", "plain"))
+        if part is not None:
+            bodies.append(part.get_content())
+    return bodies
+
+
+def synthetic_mail(offers=400, filler=4000):
+    rows = []
+    for index in range(offers):
+        rows.append(
+            f'<tr><td><a href="https://www.mypoints.com/?cmd=oh-offer-click&amp;id={index}">'
+            f'<img src="https://img.mypoints.com/{index}.png" alt="Offer {index}"></a></td></tr>'
+        )
+        rows.append(
+            f'<tr><td><a href="{LinkExtractor.GMX_PREFIX}https%3A%2F%2Fwww.mypoints.com%2F%3Fcmd%3Doh-offer-click%26gmx%3D{index}">'
+            "Shop now</a></td></tr>"
+        )
+    for index in range(filler):
+        rows.append(f'<tr><td style="padding:4px">Filler text {index} <a href="https://example.com/{index}">link</a></td></tr>')
+    return f"<html><body><table>{''.join(rows)}</table></body></html>"
+
+
+def soup_links(html):
+    """Previous extraction path of MyPoints."""
+    soup = BeautifulSoup(html, "html.parser")
+    links = {}
+    for link in [link.get("href") for link in soup.find_all("a")]:
+        if not LinkExtractor.valid_link(link):
+            continue
+        links[LinkExtractor.fix_link(link)] = None
+    return list(links)
+
+
+def measure(extract, bodies, repeat):
+    """Return seconds per mail, peak traced bytes and the links of each mail."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for body in bodies:
+            extract(body)
+    elapsed = (time.perf_counter() - start) / (repeat * len(bodies))
+
+    tracemalloc.start()
+    results = [extract(body) for body in bodies]
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return elapsed, peak, results
+
+
+def main():
+    folder = sys.argv[1] if len(sys.argv) > 1 else None
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_REPEAT
+
+    bodies = load_corpus(folder) if folder else [synthetic_mail()]
+    if not bodies:
+        print(f"No mails found in {folder}")
+        return
+
+    size = sum(len(body) for body in bodies)
+    print(f"{len(bodies)} mails, {size / 1024:.0f} KiB html, {repeat} runs")
+
+    paths = [("LinkExtractor", LinkExtractor.extract_links)]
+    if BeautifulSoup is not None:
+        paths.append(("BeautifulSoup", soup_links))
+    else:
+        print("bs4 is not installed, skipping BeautifulSoup")
+
+    results = {}
+    for name, extract in paths:
+        elapsed, peak, results[name] = measure(extract, bodies, repeat)
+        links = sum(len(links) for links in results[name])
+        print(f"{name:14} {elapsed * 1000:8.2f} ms/mail {peak / 1024:8.0f} KiB peak {links:6} links")
+
+    if len(results) > 1:
+        # The streaming path also recognizes offer links wrapped by the GMX redirect
+        missing = sum(
+            len(set(soup) - set(streamed))
+            for soup, streamed in zip(results["BeautifulSoup"], results["LinkExtractor"])
+        )
+        print(f"Links found only by BeautifulSoup: {missing}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,137 +1,559 @@
-"""App to check emails from MyPoints"""
+"""App to check emails from MyPoints
+
+ Args:
+    servers: List of accounts with server, email, passwd and folder (required)
+    max_workers: Number of accounts checked at the same time (default = 4)
+    account_timeout: Seconds to wait for each account (default = 300 seconds)
+    summary_sensor: Sensor updated with the summary of each check (default = sensor.mypoints)
+    idle: Keep a connection open per account and process new mail as soon as it arrives
+          using IMAP IDLE instead of checking every 4 hours (default = True)
+    click_workers: Number of offer links clicked at the same time for all accounts (default = 4)
+    ledger_days: Days a clicked offer is remembered so that it is not clicked again (default = 30 days)
+    click_attempts: Checks in which an offer is clicked before it is given up (default = 5)
+    click_retry_hours: Hours after the first failure after which an offer is given up (default = 24 hours)
+
+"""
 import hassapi as hass
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime, timedelta
+import hashlib
+import math
+import threading
+import time
 import requests
-import urllib.parse
+from urllib3.util.retry import Retry
+import AppUtils
+import LinkExtractor
 
 from imapclient import IMAPClient
 from packages.mailparser import MailParser
-from bs4 import BeautifulSoup
 
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_ACCOUNT_TIMEOUT = 300  # 5 minutes
+DEFAULT_SUMMARY_SENSOR = "sensor.mypoints"
+
+MYPOINTS_SENDER = "@mypoints.com"
+
+DEFAULT_CLICK_WORKERS = 4
+CLICK_TIMEOUT = (10, 30)  # Connect and read timeouts in seconds
+CLICK_RETRIES = 3
+CLICK_RETRY_BACKOFF = 1  # Seconds before the first retry, doubled for every retry
+DEFAULT_LEDGER_DAYS = 30
+DEFAULT_CLICK_ATTEMPTS = 5
+DEFAULT_CLICK_RETRY_HOURS = 24
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/99.0.4844.82 Safari/537.36"
+
+# IDLE is renewed before the 29 minutes servers may drop it after (RFC 2177)
+IDLE_RENEW_INTERVAL = 25 * 60
+IDLE_CHECK_INTERVAL = 30  # Seconds between checks for stop while idling
+POLL_INTERVAL = 5 * 60  # NOOP polling for servers without IDLE
+RECONNECT_DELAY = 10  # Seconds before the first reconnect, doubled for every failure
+MAX_RECONNECT_DELAY = 30 * 60
+
+
+def get_offer_id(link):
+    return hashlib.sha1(link.encode()).hexdigest()
+
+
+class ClickLedger:
+    """Offers clicked by any account and the time they were clicked, persisted so
+    that each offer is clicked only once. Entries are evicted after ttl seconds.
+
+    Failed offers are tracked with the number of attempts and the time of the
+    first failure. An offer is given up after max_attempts or retry_ttl seconds
+    so that the mail with an expired offer is not processed again forever"""
+
+    def __init__(self, path, ttl, max_attempts=DEFAULT_CLICK_ATTEMPTS, retry_ttl=DEFAULT_CLICK_RETRY_HOURS * 3600):
+        self.path = path
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+        self.retry_ttl = retry_ttl
+        self.lock = threading.Lock()
+
+        data = AppUtils.load_json(path, {})
+        if "clicked" not in data:
+            # Previous format with only the clicked offers
+            data = {"clicked": data}
+        self.clicked = data["clicked"]
+        self.failed = data.get("failed", {})  # [attempts, first failure time] keyed by offer
+        self.pending = set()
+        self.evict()
+
+    def evict(self):
+        cutoff = time.time() - self.ttl
+        for offer_id in [offer_id for offer_id, clicked_at in self.clicked.items() if clicked_at < cutoff]:
+            del self.clicked[offer_id]
+        for offer_id in [offer_id for offer_id, (_, failed_at) in self.failed.items() if failed_at < cutoff]:
+            del self.failed[offer_id]
+
+    def claim(self, offer_id):
+        """Returns True if the caller should click the offer"""
+        with self.lock:
+            if offer_id in self.clicked or offer_id in self.pending or self._is_abandoned(offer_id):
+                return False
+            self.pending.add(offer_id)
+            return True
+
+    def release(self, offer_id, clicked):
+        with self.lock:
+            self.pending.discard(offer_id)
+            if clicked:
+                self.clicked[offer_id] = time.time()
+                self.failed.pop(offer_id, None)
+            else:
+                attempts, failed_at = self.failed.get(offer_id, (0, time.time()))
+                self.failed[offer_id] = [attempts + 1, failed_at]
+
+    def is_clicked(self, offer_id):
+        with self.lock:
+            return offer_id in self.clicked
+
+    def is_abandoned(self, offer_id):
+        """Returns True if the offer failed too often or for too long to be clicked again"""
+        with self.lock:
+            return self._is_abandoned(offer_id)
+
+    def _is_abandoned(self, offer_id):
+        failure = self.failed.get(offer_id)
+        if failure is None:
+            return False
+        attempts, failed_at = failure
+        return attempts >= self.max_attempts or time.time() - failed_at >= self.retry_ttl
+
+    def save(self):
+        with self.lock:
+            self.evict()
+            AppUtils.save_json(self.path, {"clicked": self.clicked, "failed": self.failed})
+
+
+class AccountWatcher(threading.Thread):
+    """Keeps a connection to an account open and processes new mail as soon as
+    the server reports it, reconnecting with backoff when the connection fails"""
+
+    def __init__(self, app, item):
+        super().__init__(name=f"{app.name}_{item['server']}", daemon=True)
+        self.app = app
+        self.item = item
+        self.stop_event = threading.Event()
+        self.client = None
+        self.connected = False  # Set once the current attempt logged in
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        server = self.item["server"]
+        delay = RECONNECT_DELAY
+        while not self.stop_event.is_set():
+            self.connected = False
+            try:
+                self.watch()
+            except Exception as error:
+                self.app.log(f"{server}: Connection error {error}")
+            finally:
+                self.logout()
+
+            if self.stop_event.is_set():
+                break
+
+            # A connection that dropped after logging in starts the backoff over
+            if self.connected:
+                delay = RECONNECT_DELAY
+
+            self.app.log(f"{server}: Reconnecting in {delay} seconds")
+            self.stop_event.wait(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    def logout(self):
+        if self.client is not None:
+            try:
+                self.client.logout()
+            except Exception:
+                pass
+            self.client = None
+
+    def process(self, folder_info=None):
+        self.app.process_account(self.client, self.item, folder_info)
+
+    def watch(self):
+        """Process new mail until stopped or the connection fails"""
+        server = self.item["server"]
+
+        summary = {}
+        self.client, folder_info = self.app.connect(
+            server, self.item["email"], self.item["passwd"], self.item["folder"], summary
+        )
+        if self.client is None:
+            return
+        self.connected = True
+
+        # Catch up with the mail received while disconnected
+        self.process(folder_info)
+
+        use_idle = self.client.has_capability("IDLE")
+        self.app.log(f"{server}: Waiting for new mail using {'IDLE' if use_idle else 'NOOP'}")
+
+        while not self.stop_event.is_set():
+            if use_idle:
+                new_mail = self.idle()
+            else:
+                self.stop_event.wait(POLL_INTERVAL)
+                new_mail = self.has_new_mail(self.client.noop()[1])
+
+            if self.stop_event.is_set():
+                break
 
-GMX_PREFIX = "https://deref-gmx.com/mail/client/Xd-wFjnrIUA/dereferrer/?redirectUrl="
+            if new_mail:
+                self.process()
+            else:
+                # Keep alive and detect dropped connections
+                self.client.noop()
+
+    def idle(self):
+        """IDLE until the server reports new mail, renewal or stop"""
+        self.client.idle()
+        try:
+            start = time.monotonic()
+            while not self.stop_event.is_set() and time.monotonic() - start < IDLE_RENEW_INTERVAL:
+                if self.has_new_mail(self.client.idle_check(timeout=IDLE_CHECK_INTERVAL)):
+                    return True
+            return False
+        finally:
+            self.client.idle_done()
+
+    def has_new_mail(self, responses):
+        return any(len(response) > 1 and response[1] in (b"EXISTS", b"RECENT") for response in responses)
 
 
 class MyPoints(hass.Hass):
+    executor = None
+    watchers = None
+    click_executor = None
+    session = None
+
     def initialize(self):
         self.servers = self.args["servers"]
         # for item in servers:
         #    self.log(f'{item["server"]} {item["email"]} {item["passwd"]} {item["folder"]}')
 
-        self.run_every(self.check, "now", 4 * 3600)  # Every 4 hours
+        self.account_timeout = self.args.get("account_timeout", DEFAULT_ACCOUNT_TIMEOUT)
+        self.summary_sensor = self.args.get("summary_sensor", DEFAULT_SUMMARY_SENSOR)
+
+        # Accounts are checked concurrently so that a slow server does not delay the others
+        self.max_workers = min(self.args.get("max_workers", DEFAULT_MAX_WORKERS), len(self.servers))
+
+        # Checks still running per account, a timed out check keeps running in its worker
+        self.running = {}
+
+        # Latest summary per account for the IDLE connections
+        self.account_summaries = {}
+        self.summary_lock = threading.Lock()
+
+        # UIDVALIDITY and last processed UID per account folder so that each check
+        # only fetches new mail, shared by the account workers
+        self.uids_file = AppUtils.get_storage_path(f"{self.name}.uids.json")
+        self.uids_lock = threading.Lock()
+        self.uids = AppUtils.load_json(self.uids_file, {})
+
+        # Offer links of all accounts are clicked through a bounded pool sharing the connections
+        click_workers = self.args.get("click_workers", DEFAULT_CLICK_WORKERS)
+        self.click_executor = ThreadPoolExecutor(max_workers=click_workers, thread_name_prefix=f"{self.name}_click")
+
+        retry = Retry(
+            total=CLICK_RETRIES,
+            backoff_factor=CLICK_RETRY_BACKOFF,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["GET"],
+        )
+        self.session = requests.Session()
+        self.session.headers["user-agent"] = USER_AGENT
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=click_workers, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.ledger = ClickLedger(
+            AppUtils.get_storage_path(f"{self.name}.clicked.json"),
+            self.args.get("ledger_days", DEFAULT_LEDGER_DAYS) * 24 * 3600,
+            self.args.get("click_attempts", DEFAULT_CLICK_ATTEMPTS),
+            self.args.get("click_retry_hours", DEFAULT_CLICK_RETRY_HOURS) * 3600,
+        )
+
+        if self.args.get("idle", True):
+            self.watchers = [AccountWatcher(self, item) for item in self.servers]
+            for watcher in self.watchers:
+                watcher.start()
+        else:
+            self.executor = ThreadPoolExecutor(
+                max_workers=max(self.max_workers, 1), thread_name_prefix=f"{self.name}_account"
+            )
+            self.run_every(self.check, "now", 4 * 3600)  # Every 4 hours
         # self.log("Initialized")
 
-    def check(self, kwargs=None):
-        for item in self.servers:
-            self.check_emails(item["server"], item["email"], item["passwd"], item["folder"])
-
-    def valid_email(self, from_):
-        email_from = list(from_)
-        email_from_tuple = email_from[0]  # Use first tuple
-
-        for item in email_from_tuple:
-            # self.log(f"Checking {item}")
+    def terminate(self):
+        if self.watchers is not None:
+            # The watchers log out when they see the stop within IDLE_CHECK_INTERVAL
+            for watcher in self.watchers:
+                watcher.stop()
+            self.watchers = None
 
-            if item.find("@mypoints.com") != -1:
-                return True
-        return False
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
 
-    def valid_link(self, link):
-        if not link:
-            return False
-        return link.find("mypoints.com/?cmd=oh-offer-click") != -1
-
-        # if link.find("account-settings#close-account") != -1:
-        #     return False
-        # if link.find("mp-ac-email-unsub") != -1:
-        #     return False
-        # if link.find("mp-ac-email-client-optout") != -1:
-        #     return False
-        # if link.find("mypoints.com/account-statement") != -1:
-        #     return False
+        if self.click_executor is not None:
+            self.click_executor.shutdown(wait=False)
+            self.click_executor = None
 
-    def fix_link(self, link: str):
-        if link.find(GMX_PREFIX) != -1:
-            link = link[len(GMX_PREFIX) :]
+        if self.session is not None:
+            self.session.close()
+            self.session = None
 
-        # https://stackoverflow.com/questions/8689795/how-can-i-remove-non-ascii-characters-but-leave-periods-and-spaces-using-python
-        link = link.encode("ascii", errors="ignore").decode()
-        return urllib.parse.unquote(link)
+    def check(self, kwargs=None):
+        start = time.monotonic()
 
-    def check_emails(self, server, email, passwd, folder):
-        flag = "ALL"
-        # 'UNSEEN'
+        futures = {}
+        for item in self.servers:
+            server = item["server"]
+            running = self.running.get(server)
+            if running is not None and not running.done():
+                self.log(f"{server}: Previous check still running, skipping")
+                continue
+
+            future = self.executor.submit(
+                self.check_emails, item["server"], item["email"], item["passwd"], item["folder"]
+            )
+            self.running[server] = future
+            futures[future] = server
+
+        # Accounts beyond max_workers wait for a free worker
+        rounds = math.ceil(len(futures) / self.max_workers) if futures else 0
+        done, not_done = wait(futures, timeout=self.account_timeout * rounds)
+
+        accounts = {}
+        for future, server in futures.items():
+            if future in not_done:
+                self.log(f"{server}: Timed out after {self.account_timeout} seconds")
+                accounts[server] = {"error": "timeout"}
+                continue
+
+            try:
+                accounts[server] = future.result()
+            except Exception as error:
+                self.log(f"{server}: Error {error}")
+                accounts[server] = {"error": str(error)}
+
+        self.update_summary(accounts, time.monotonic() - start)
+
+    def process_account(self, client, item, folder_info=None):
+        """Process the new mail of a connected account and update its summary"""
+        server = item["server"]
+        start = time.monotonic()
+        summary = {"messages": 0, "links": 0, "clicked": 0}
+
+        # Select again for the current UIDNEXT unless the folder was just selected
+        if folder_info is None:
+            folder_info = client.select_folder(item["folder"], readonly=False)
+        self.process_new_mail(client, folder_info, server, item["email"], item["folder"], summary)
+        summary["duration"] = round(time.monotonic() - start, 1)
+
+        with self.summary_lock:
+            self.account_summaries[server] = summary
+            self.update_summary(dict(self.account_summaries), summary["duration"])
+
+    def update_summary(self, accounts, duration):
+        messages = sum(account.get("messages", 0) for account in accounts.values())
+        links = sum(account.get("links", 0) for account in accounts.values())
+        clicked = sum(account.get("clicked", 0) for account in accounts.values())
+        self.log(f"Checked {len(accounts)} accounts in {duration:.1f}s: {messages} messages, {clicked}/{links} links clicked")
+
+        self.set_state(
+            self.summary_sensor,
+            state=clicked,
+            attributes={
+                "friendly_name": "MyPoints",
+                "icon": "mdi:email-check",
+                "messages": messages,
+                "links": links,
+                "clicked": clicked,
+                "duration": round(duration, 1),
+                "accounts": accounts,
+                "last_check": datetime.now().isoformat(),
+            },
+        )
+
+    def valid_email(self, envelope):
+        if not envelope or not envelope.from_:
+            return False
 
+        address = envelope.from_[0]  # Use first address
+        sender = f"{(address.mailbox or b'').decode(errors='ignore')}@{(address.host or b'').decode(errors='ignore')}"
+        # self.log(f"Checking {sender}")
+
+        return sender.lower().find(MYPOINTS_SENDER) != -1
+
+    def save_last_uid(self, account_key, uidvalidity, last_uid):
+        with self.uids_lock:
+            self.uids[account_key] = {"uidvalidity": uidvalidity, "last_uid": last_uid}
+            try:
+                AppUtils.save_json(self.uids_file, self.uids)
+            except OSError as error:
+                self.log(f"Error saving UIDs {error}")
+
+    def click_link(self, server, link):
+        """Returns clicked, skipped if the offer was already clicked, abandoned if it
+        failed too often to be clicked again or failed"""
+        offer_id = get_offer_id(link)
+        if not self.ledger.claim(offer_id):
+            if self.ledger.is_clicked(offer_id):
+                return "skipped"
+            # Another account could still be clicking it
+            return "abandoned" if self.ledger.is_abandoned(offer_id) else "failed"
+
+        clicked = False
         try:
-            client = IMAPClient(server, use_uid=True)
+            response = self.session.get(link, timeout=CLICK_TIMEOUT)
+            clicked = response.status_code == 200
+            if not clicked:
+                # self.log(response.text)
+                self.log(f"{server} {link} => {response.status_code}")
+        except requests.RequestException as error:
+            self.log(f"{server} {link} => {error}")
+        finally:
+            self.ledger.release(offer_id, clicked)
+
+        if clicked:
+            return "clicked"
+        if self.ledger.is_abandoned(offer_id):
+            self.log(f"{server} {link} => Giving up")
+            return "abandoned"
+        return "failed"
+
+    def connect(self, server, email, passwd, folder, summary):
+        """Returns the logged in client and the selected folder info, (None, None) on error"""
+        try:
+            client = IMAPClient(server, use_uid=True, timeout=self.account_timeout)
         except Exception as error:
             self.log(f"{server}: Unable to connect to {server}: {error}")
-            return
+            summary["error"] = "connect"
+            return None, None
 
         try:
             client.login(email, passwd)
         except Exception as error:
-            self.log(f"{server}: IMAPClient login error for {email}/{passwd}: {error}")
-            return
+            self.log(f"{server}: IMAPClient login error for {email}: {error}")
+            summary["error"] = "login"
+            return None, None
 
         try:
-            client.select_folder(folder, readonly=False)
+            folder_info = client.select_folder(folder, readonly=False)
         except Exception as error:
             self.log(f"{server}: Error selecting folder {error}")
+            summary["error"] = "folder"
 
             client.logout()
-            return
+            return None, None
+
+        return client, folder_info
+
+    def check_emails(self, server, email, passwd, folder):
+        """Click the offer links of the account, returns the account summary"""
+        flag = "ALL"
+        # 'UNSEEN'
+        start = time.monotonic()
+        summary = {"messages": 0, "links": 0, "clicked": 0}
 
-        # emails = []
+        client, folder_info = self.connect(server, email, passwd, folder, summary)
+        if client is None:
+            return summary
+
+        self.process_new_mail(client, folder_info, server, email, folder, summary)
+
+        # self.log(f"{server}: Logout")
+        client.logout()
+
+        summary["duration"] = round(time.monotonic() - start, 1)
+        return summary
+
+    def process_new_mail(self, client, folder_info, server, email, folder, summary):
+        """Click the offer links of the mail after the last processed UID"""
+        account_key = f"{server}/{email}/{folder}"
         unique_links = {}
-        today = datetime.today()
-        cutoff = (today - timedelta(days=1)).strftime("%d-%b-%Y")
-        self.log(f"{server}: Connected, getting  emails since {cutoff}")
+        new_last_uid = None
+        uidvalidity = folder_info.get(b"UIDVALIDITY")
+        with self.uids_lock:
+            uids = self.uids.get(account_key)
 
         try:
-            # messages = client.search(flag)
-            messages = client.search(["SINCE", cutoff])
-
-            message_items = client.fetch(messages, "RFC822").items()
-            self.log(f"{server}: {len(message_items)} messages since {cutoff}")
+            # Only the mypoints mail after the last processed UID, the server filters
+            # the sender. Mail since yesterday if the folder was never checked or the
+            # UIDs were reset
+            if uids and uids["uidvalidity"] == uidvalidity:
+                last_uid = uids["last_uid"]
+                self.log(f"{server}: Connected, getting emails after UID {last_uid}")
+                messages = client.search(["UID", f"{last_uid + 1}:*", "FROM", MYPOINTS_SENDER])
+
+                # n:* always includes the last message even if its UID is lower
+                messages = [uid for uid in messages if uid > last_uid]
+            else:
+                last_uid = 0
+                today = datetime.today()
+                cutoff = (today - timedelta(days=1)).strftime("%d-%b-%Y")
+                self.log(f"{server}: Connected, getting emails since {cutoff}")
+                messages = client.search(["SINCE", cutoff, "FROM", MYPOINTS_SENDER])
+
+            summary["messages"] = len(messages)
+
+            # All the mail in the folder when selected has been seen after this check
+            uidnext = folder_info.get(b"UIDNEXT")
+            new_last_uid = max([last_uid] + messages + ([uidnext - 1] if uidnext else []))
+
+            # Headers first, only the bodies of the mypoints mail are fetched
+            envelopes = client.fetch(messages, "ENVELOPE") if messages else {}
+            mypoints_uids = [
+                uid for uid, message_data in envelopes.items() if self.valid_email(message_data.get(b"ENVELOPE"))
+            ]
+
+            message_items = client.fetch(mypoints_uids, "RFC822").items() if mypoints_uids else []
+            self.log(f"{server}: {len(messages)} new messages, {len(mypoints_uids)} from mypoints")
 
             for uid, message_data in message_items:
                 try:
                     mail = MailParser.from_bytes(message_data[b"RFC822"])
 
                     # mail.from_, mail.subject, mail.body
-                    if not self.valid_email(mail.from_):
-                        continue
-
-                    soup = BeautifulSoup(mail.body, "html.parser")
-                    links = [link.get("href") for link in soup.find_all("a")]
-                    for link in links:
-                        if not self.valid_link(link):
-                            continue
-
-                        unique_links[self.fix_link(link)] = uid
+                    for link in LinkExtractor.extract_links(mail.body):
+                        unique_links.setdefault(link, []).append(uid)
 
                 except Exception as err:
                     self.log(f"{server}: Parsing error: {err}")
 
         except Exception as err:
             self.log(f"{server}: IMAPClient error {err}")
+            new_last_uid = None
 
+        summary["links"] = len(unique_links)
         if len(unique_links):
             # self.log(f"{server}: {len(unique_links)} links")
-            uids_to_delete = []
-            for link in unique_links:
-                uid = unique_links[link]
-                headers = {
-                    "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/99.0.4844.82 Safari/537.36"
-                }
-                response = requests.get(link, headers=headers)
-
-                if response.status_code == 200:
-                    uids_to_delete.append(uid)
-                else:
-                    # self.log(response.text)
-                    self.log(f"{server} {link} => {response.status_code}")
+            links = list(unique_links)
+            results = dict(zip(links, self.click_executor.map(lambda link: self.click_link(server, link), links)))
+
+            # Mail is deleted once all its offers are clicked, now or before, or given up
+            uid_results = {}
+            for link, link_uids in unique_links.items():
+                for uid in link_uids:
+                    uid_results.setdefault(uid, []).append(results[link])
+                if results[link] == "clicked":
+                    summary["clicked"] += 1
+
+            # Failed attempts are counted too
+            if any(status != "skipped" for status in results.values()):
+                try:
+                    self.ledger.save()
+                except OSError as error:
+                    self.log(f"Error saving clicked offers {error}")
+
+            uids_to_delete = [uid for uid, statuses in uid_results.items() if "failed" not in statuses]
+            failed_uids = [uid for uid, statuses in uid_results.items() if "failed" in statuses]
 
             if uids_to_delete:
                 try:
@@ -143,5 +565,10 @@ class MyPoints(hass.Hass):
                 except Exception as err:
                     self.log(f"{server}: Error deleting {err}")
 
-        # self.log(f"{server}: Logout")
-        client.logout()
+            # Mail with links that could not be clicked is processed again next time, the ledger
+            # gives up failing offers so that this does not hold the last UID back forever
+            if failed_uids and new_last_uid is not None:
+                new_last_uid = min(failed_uids) - 1
+
+        if new_last_uid is not None and uids != {"uidvalidity": uidvalidity, "last_uid": new_last_uid}:
+            self.save_last_uid(account_key, uidvalidity, new_last_uid)
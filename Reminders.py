@@ -5,9 +5,11 @@ Sample output:
     "Family zoom" will generate "Family zoom in 2 minutes."
 
  Args:
-    feed: iCal feed url (required)
+    feed: iCal feed url or list of feed urls (required)
+    feed_timeout: Seconds to wait for the feed downloads, a slower feed keeps its last events (default = 30 seconds)
     alexa_devices: Alexa devices to send announcement
     google_devices: Google devices to send announcement
+    announce_timeout: Seconds to wait for each announcement target (default = 10 seconds)
     reminder_sensor: sensor to update with next reminder details (required)
     fetch_interval: Minutes between calendar fetch (default = 10 minutes)
     reminder_offset: Minutes before the event for sending notification (default = 2 minutes)
@@ -19,7 +21,13 @@ Sample output:
 
 """
 
+import hashlib
+import heapq
+import io
+import itertools
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import date, datetime, timedelta
 
 import adbase as ad
@@ -36,11 +44,368 @@ DEFAULT_REMINDER_OFFSET = 2  # 2 minutes
 DEFAULT_START_HOUR = 7  # 7 AM
 DEFAULT_END_HOUR = 20  # 8 PM
 
+DEFAULT_FEED_TIMEOUT = 30  # 30 seconds
+
+DEFAULT_ANNOUNCE_TIMEOUT = 10  # 10 seconds
+ANNOUNCE_RETRIES = 2
+ANNOUNCE_RETRY_DELAY = 0.5  # Seconds before the first retry, doubled for every retry
+
+# Number of days for which occurrences are indexed when the feed changes
+OCCURRENCE_INDEX_DAYS = 7
+
+# Slack in days when comparing raw DTSTART dates, the raw value could be in a different timezone
+WINDOW_MARGIN_DAYS = 1
+
+
+def get_ical_date(value: str):
+    """Returns the date of an iCal DATE or DATE-TIME value (e.g. 20240101 or 20240101T080000Z)."""
+    try:
+        return datetime.strptime(value[:8], "%Y%m%d").date()
+    except ValueError:
+        return None
+
+
+def can_reach_window(properties, first_day: date, last_day: date) -> bool:
+    """
+    Determine if an event can have occurrences between first_day and last_day.
+
+    :param dict properties: Unfolded property values of the event keyed by property name
+    :param date first_day: First day of the window
+    :param date last_day: Last day of the window
+    """
+    margin = timedelta(days=WINDOW_MARGIN_DAYS)
+    first_day = first_day - margin
+    last_day = last_day + margin
+
+    # A modified occurrence of a recurring event has to be kept if it was moved out of the window, otherwise
+    # the original occurrence would be generated again
+    recurrence_id = get_ical_date(properties.get("RECURRENCE-ID", ""))
+    if recurrence_id is not None and first_day <= recurrence_id <= last_day:
+        return True
+
+    event_start = get_ical_date(properties.get("DTSTART", ""))
+    if event_start is None:
+        return True  # Let the calendar parser decide
+    if event_start > last_day:
+        return False
+
+    if "RRULE" in properties or "RDATE" in properties:
+        if "RDATE" in properties:
+            return True
+
+        for part in properties["RRULE"].split(";"):
+            if part.startswith("UNTIL="):
+                until = get_ical_date(part[len("UNTIL=") :])  # noqa: E203
+                return until is None or until >= first_day
+        return True
+
+    # Single events and occurrences moved into the window
+    event_end = get_ical_date(properties.get("DTEND", "")) or event_start
+    return event_end >= first_day
+
+
+def filter_feed_text(feed_text: str, first_day: date, last_day: date) -> str:
+    """
+    Stream through the feed and drop the events which cannot occur between first_day and last_day.
+    Everything outside VEVENT components (calendar properties, timezones) is kept as is.
+    """
+    output = io.StringIO()
+    event_lines = None
+    properties = None
+    name = None
+
+    for line in io.StringIO(feed_text):
+        if event_lines is None:
+            if line.rstrip("\r\n") == "BEGIN:VEVENT":
+                event_lines = [line]
+                properties = {}
+                name = None
+            else:
+                output.write(line)
+            continue
+
+        event_lines.append(line)
+        if line[:1] in (" ", "\t"):  # Folded line
+            if name is not None:
+                properties[name] += line[1:].rstrip("\r\n")
+            continue
+
+        content = line.rstrip("\r\n")
+        if content == "END:VEVENT":
+            if can_reach_window(properties, first_day, last_day):
+                output.writelines(event_lines)
+            event_lines = None
+            continue
+
+        # Property name ends at the first parameter or value separator
+        pos = min((i for i in (content.find(";"), content.find(":")) if i != -1), default=-1)
+        name = content[:pos].upper() if pos != -1 else None
+
+        # Only the first occurrence is of interest, nested VALARM properties are ignored
+        if name is not None and name not in properties:
+            properties[name] = content[content.find(":") + 1 :]  # noqa: E203
+        else:
+            name = None
+
+    return output.getvalue()
+
+
+class CalendarFeed:
+    """
+    Represents an iCal feed along with its cache. The validators and text are persisted so that restarts can make
+    a conditional request, the occurrences are kept in memory.
+    """
+
+    def __init__(self, url: str, cache_file: str):
+        self.url = url
+        self.cache_file = cache_file
+        self.etag = None
+        self.last_modified = None
+        self.hash = None
+        self.text = None
+        self.cache_dirty = False
+        self.occurrences = None  # Occurrences of the feed events keyed by day
+        self.occurrences_range = None  # First and last day covered by occurrences
+
+    def load_cache(self) -> bool:
+        """Load the cache saved by a previous run."""
+        data = AppUtils.load_json(self.cache_file, {})
+        if data.get("feed") != self.url:
+            return False
+
+        self.etag = data.get("etag")
+        self.last_modified = data.get("last_modified")
+        self.hash = data.get("hash")
+        self.text = data.get("text")
+        return True
+
+    def save_cache(self):
+        """Persist the cache."""
+        AppUtils.save_json(
+            self.cache_file,
+            {
+                "feed": self.url,
+                "etag": self.etag,
+                "last_modified": self.last_modified,
+                "hash": self.hash,
+                "text": self.text,
+            },
+        )
+
+    def download(self, session: requests.Session, timeout):
+        """Download the feed text using a conditional request. Returns None if the feed was not modified."""
+        headers = {}
+        if self.text is not None:
+            if self.etag:
+                headers["If-None-Match"] = self.etag
+            if self.last_modified:
+                headers["If-Modified-Since"] = self.last_modified
+
+        response = session.get(self.url, headers=headers, timeout=timeout)
+        if response.status_code == 304:
+            return None
+
+        response.raise_for_status()
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if (etag, last_modified) != (self.etag, self.last_modified):
+            self.etag = etag
+            self.last_modified = last_modified
+            self.cache_dirty = True
+
+        return response.text
+
+    def update(self, session: requests.Session, timeout, day: date, localTZ, offline=False) -> bool:
+        """
+        Fetch the feed and index it if it changed or day is outside of the indexed days.
+        Returns True if the occurrences changed.
+
+        :param bool offline: Use the cached text if there is one instead of downloading the feed
+        """
+        feed_text = None
+        if not (offline and self.text is not None):
+            try:
+                feed_text = self.download(session, timeout)
+            except Exception:
+                # Index the cached text so that the reminders survive a feed outage, e.g. after a restart
+                if self.text is not None and not self.is_indexed(day):
+                    self.build_occurrence_index(day, localTZ)
+                raise
+
+        if feed_text is not None:
+            feed_hash = hashlib.sha256(feed_text.encode()).hexdigest()
+            if feed_hash != self.hash:
+                self.hash = feed_hash
+                self.text = feed_text
+                self.cache_dirty = True
+                self.occurrences = None
+
+        if self.cache_dirty:
+            self.cache_dirty = False
+            self.save_cache()
+
+        if self.is_indexed(day):
+            return False
+
+        self.build_occurrence_index(day, localTZ)
+        return True
+
+    def is_indexed(self, day: date) -> bool:
+        """Returns True if the occurrences of day are indexed."""
+        if self.occurrences is None:
+            return False
+
+        first_day, last_day = self.occurrences_range
+        return first_day <= day <= last_day
+
+    def build_occurrence_index(self, first_day: date, localTZ):
+        """Index the occurrences of the cached text for OCCURRENCE_INDEX_DAYS days starting at first_day."""
+        last_day = first_day + timedelta(days=OCCURRENCE_INDEX_DAYS - 1)
+
+        calendar = CalendarFeed.parse_calendar(filter_feed_text(self.text, first_day, last_day), localTZ)
+
+        start_time = localTZ.localize(datetime.combine(first_day, datetime.min.time()))
+        end_time = localTZ.localize(datetime.combine(last_day + timedelta(days=1), datetime.min.time()))
+
+        occurrences = {}
+        for event in recurring_ical_events.of(calendar).between(start_time, end_time):
+            # event_start can sometime in UTC, convert it to local for comparison
+            event_start = event["DTSTART"].dt.astimezone(localTZ)
+            occurrences.setdefault(event_start.date(), []).append(
+                (event_start, str(event["SUMMARY"]), str(event["UID"]))
+            )
+
+        self.occurrences = occurrences
+        self.occurrences_range = (first_day, last_day)
+
+    def get_occurrences(self, day: date):
+        """Returns the (start, summary, UID) occurrences for the day."""
+        if self.occurrences is None:
+            return []
+        return self.occurrences.get(day, [])
+
+    @staticmethod
+    def parse_calendar(feed_text, localTZ):
+        """Parse the feed text into a calendar, date only DTSTART values are converted to local datetime."""
+
+        # recurring_ical_events supports recurring events
+        calendar = icalendar.Calendar.from_ical(feed_text)
+
+        for event in calendar.walk():
+            if isinstance(event, icalendar.cal.Event):
+                event_start_dt = event["DTSTART"].dt
+
+                # Fix event_start_dt to be datetime
+                if (not isinstance(event_start_dt, datetime)) and isinstance(event_start_dt, date):
+                    event_start_dt = datetime(
+                        year=event_start_dt.year,
+                        month=event_start_dt.month,
+                        day=event_start_dt.day,
+                        tzinfo=localTZ,
+                    )
+                    event["DTSTART"].dt = event_start_dt
+
+        return calendar
+
+
+class Reminder:
+    """Reminder for an event of the day."""
+
+    __slots__ = ("UID", "start", "summary", "message", "remind_at", "sensor_state", "timer_id", "done", "sequence")
+
+    def __init__(self, UID, start, summary):
+        self.UID = UID
+        self.start = start
+        self.summary = summary
+        self.message = None
+        self.remind_at = None
+        self.sensor_state = None
+        self.timer_id = None
+        self.done = False
+        self.sequence = None  # Sequence of the active heap entry, None if not scheduled
+
+    @property
+    def scheduled(self) -> bool:
+        return self.sequence is not None
+
+
+class ReminderScheduler:
+    """
+    Reminders keyed by UID along with a heap of the scheduled ones ordered by remind time.
+    Cancelled or rescheduled heap entries are dropped lazily when they reach the top.
+    """
+
+    def __init__(self):
+        self._reminders = {}
+        self._heap = []  # (remind_at, sequence, reminder)
+        self._counter = itertools.count()
+        self._scheduled_count = 0
+
+    def __iter__(self):
+        return iter(list(self._reminders.values()))
+
+    def __len__(self):
+        return len(self._reminders)
+
+    def get(self, UID):
+        return self._reminders.get(UID)
+
+    def add(self, reminder: Reminder):
+        self._reminders[reminder.UID] = reminder
+
+    def schedule(self, reminder: Reminder, remind_at):
+        """Schedule or reschedule the reminder."""
+        if reminder.scheduled:
+            self._scheduled_count -= 1
+
+        reminder.remind_at = remind_at
+        reminder.sequence = next(self._counter)
+        self._scheduled_count += 1
+        heapq.heappush(self._heap, (remind_at, reminder.sequence, reminder))
+
+    def cancel(self, reminder: Reminder):
+        """Cancel the reminder, its heap entry becomes stale."""
+        if reminder.scheduled:
+            reminder.sequence = None
+            self._scheduled_count -= 1
+
+            # Rebuild once most of the heap is stale
+            if len(self._heap) > 2 * self._scheduled_count + 16:
+                self._heap = [entry for entry in self._heap if entry[1] == entry[2].sequence]
+                heapq.heapify(self._heap)
+
+    def remove(self, reminder: Reminder):
+        """Cancel the reminder and forget it."""
+        self.cancel(reminder)
+        self._reminders.pop(reminder.UID, None)
+
+    def complete(self, reminder: Reminder):
+        """Mark the reminder as announced."""
+        self.cancel(reminder)
+        reminder.done = True
+        reminder.timer_id = None
+
+    def peek(self):
+        """Returns the next scheduled reminder."""
+        heap = self._heap
+        while heap and heap[0][1] != heap[0][2].sequence:
+            heapq.heappop(heap)
+        return heap[0][2] if heap else None
+
+    def clear(self):
+        self._reminders = {}
+        self._heap = []
+        self._scheduled_count = 0
+
 
 class Reminders(hass.Hass):
     data_fetch_timer = None
-    events = None  # Events for today
-    scheduled_event_uids = None
+    reminders = None  # Reminders for today
+    scheduled_day = None  # Day for which reminders have been scheduled
+    feeds = None
+    session = None
+    executor = None
+    announce_executor = None
 
     def tryLog(self, message):
         '''Conditionally log'''
@@ -48,9 +413,12 @@ class Reminders(hass.Hass):
             self.log(message)
 
     def initialize(self):
-        self.feed = self.args["feed"]
+        feed = self.args["feed"]
+        self.feed_urls = feed if isinstance(feed, list) else [feed]
+        self.feed_timeout = self.args.get("feed_timeout", DEFAULT_FEED_TIMEOUT)
         self.alexa_devices = self.args.get("alexa_devices", [])
         self.google_devices = self.args.get("google_devices", [])
+        self.announce_timeout = self.args.get("announce_timeout", DEFAULT_ANNOUNCE_TIMEOUT)
         self.no_reminder_today_sensor = self.args.get("no_reminder_today_sensor")
         self.reminder_sensor = self.args.get("reminder_sensor")
         self.reminder_sensor_friendly_name = self.args.get("reminder_sensor_friendly_name", "Reminder")
@@ -80,19 +448,49 @@ class Reminders(hass.Hass):
         # This is the same as before
         self.tryLog(f"Initialized at {self.datetime(True)} skipping days {self.skip_days}")
 
+        self.feeds = []
+        for url in self.feed_urls:
+            url_hash = hashlib.sha1(url.encode()).hexdigest()[:8]
+            feed = CalendarFeed(url, AppUtils.get_storage_path(f"{self.name}.feed.{url_hash}.json"))
+            if feed.load_cache():
+                self.tryLog(f"Loaded feed cache {feed.hash}")
+            self.feeds.append(feed)
+
         if self.test_mode:
             CURR_DIR = os.path.dirname(os.path.realpath(__file__))
             data_file = os.path.join(CURR_DIR, "basic.ics")
 
             if os.path.exists(data_file):
                 f = open(data_file, "r")
-                self.test_cached_feed_text = f.read()
+                self.feeds[0].text = f.read()
+                self.feeds[0].hash = None
                 self.tryLog("Using cached data")
 
-        self.events = {}
-        self.scheduled_event_uids = []
+        # Feeds are downloaded concurrently over a shared connection pool
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=len(self.feeds))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=len(self.feeds), thread_name_prefix=f"{self.name}_feed")
+        self.feed_futures = {}  # Update in progress per feed
+
+        # Announcements are sent to all targets concurrently
+        self.announce_targets = self.get_announce_targets()
+        self.announce_metrics = {
+            name: {"sent": 0, "failed": 0, "last_latency": None, "average_latency": None}
+            for name, _, _ in self.announce_targets
+        }
+        self.announce_executor = ThreadPoolExecutor(
+            max_workers=len(self.announce_targets), thread_name_prefix=f"{self.name}_announce"
+        )
+        self.announce_futures = {}  # Announcement in progress per target, at most one so a worker is always free
+
+        self.reminders = ReminderScheduler()
         self.set_reminder_sensor("None", None)
 
+        self.state_file = AppUtils.get_storage_path(f"{self.name}.state.json")
+        self.restore_state()
+
         # Start listening to no_school input_boolean sensor
         if self.no_reminder_today_sensor:
             self.listen_state(self.no_school_status_changed, self.no_reminder_today_sensor)
@@ -124,9 +522,22 @@ class Reminders(hass.Hass):
         return now
 
     def terminate(self):
-        self.cancel_reminders()
+        # Keep the saved state so that a restart can re-arm the reminders
+        self.cancel_reminder_timers()
         self.cancel_recurring_fetch()
 
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+        if self.announce_executor is not None:
+            self.announce_executor.shutdown(wait=False)
+            self.announce_executor = None
+
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
     def cancel_recurring_fetch(self):
         """Cancel the recurring fetch timer."""
         if self.data_fetch_timer is not None:
@@ -215,7 +626,6 @@ class Reminders(hass.Hass):
     def fetch_data(self, kwargs=None):
         """Fetches new Calendar data"""
 
-        localTZ = pytz.timezone(self.get_timezone())
         current_time = self.get_current_instant()
 
         self.tryLog(f"[{current_time}] fetch_data")
@@ -226,123 +636,206 @@ class Reminders(hass.Hass):
             self.set_recurring_fetch()
             return
 
-        try:
-            if self.test_mode and self.test_cached_feed_text:
-                feed_text = self.test_cached_feed_text
-                self.tryLog("Using cached feed text")
-            else:
-                feed_text = requests.get(self.feed).text
-                # self.tryLog(feed_text)
+        # Always fetch from starting time
+        start_time = current_time.replace(hour=self.start_hour, minute=0, second=0, microsecond=0)
+        end_time = start_time.replace(hour=self.end_hour)
 
-                if self.test_mode:
-                    self.test_cached_feed_text = feed_text
-        except Exception as error:
-            self.tryLog(f"Error getting calendar feed {error}")
+        feed_changed = self.update_feeds(start_time.date())
+        if all(feed.occurrences is None for feed in self.feeds):
             return
 
-        # recurring_ical_events supports recurring events
-        calendar = icalendar.Calendar.from_ical(feed_text)
-
-        for event in calendar.walk():
-            if isinstance(event, icalendar.cal.Event):
-                event_start_dt = event["DTSTART"].dt
-
-                # Fix event_start_dt to be datetime
-                if (not isinstance(event_start_dt, datetime)) and isinstance(event_start_dt, date):
-                    # self.log(f'{event_start_dt} {event["SUMMARY"]} dateOnly')
-                    event_start_dt = datetime(
-                        year=event_start_dt.year,
-                        month=event_start_dt.month,
-                        day=event_start_dt.day,
-                        tzinfo=localTZ,
-                    )
-                    # self.tryLog(f'Fixed {event["SUMMARY"]} to {event_start_dt}')
-                    event["DTSTART"].dt = event_start_dt
+        # Nothing to do if the feeds are unchanged and reminders have already been scheduled for the day
+        if not feed_changed and self.scheduled_day == start_time.date():
+            self.tryLog("Feeds unchanged, keeping scheduled reminders")
+            return
 
-        # Always fetch from starting time
-        start_time = current_time.replace(hour=self.start_hour, minute=0, second=0, microsecond=0)
-        end_time = start_time.replace(hour=self.end_hour)
+        self.scheduled_day = start_time.date()
 
-        reminder_state_set = False
         self.tryLog(f"Getting events between {start_time} - {end_time}")
-        events = recurring_ical_events.of(calendar).between(start_time, end_time)
-        events.sort(key=Reminders.get_starttime)
+        events = self.get_merged_events(start_time, end_time)
 
         self.tryLog(f"Found {len(events)} events")
 
-        for event in events:
-            summary = event["SUMMARY"]
-            event_start = event["DTSTART"].dt
-            UID = event["UID"]
+        # Drop reminders of the events which are no longer in the feeds so that they are not saved and re-armed
+        # by a restart. Announced reminders are kept, the event could come back.
+        UIDs = set(UID for _, _, UID in events)
+        for reminder in self.reminders:
+            if reminder.UID not in UIDs and not reminder.done:
+                self.tryLog(f"Event '{reminder.summary}' was removed")
+                self.cancel_reminder(reminder)
+                self.reminders.remove(reminder)
 
-            # event_start can sometime in UTC, convert it to local for comparison
-            event_start = event_start.astimezone(localTZ)
+        for event_start, summary, UID in events:
             self.tryLog(f"{summary} @ {event_start} {UID}")
 
-            if UID in self.events:
-                if not self.events[UID]["done"]:
-                    # if event time changed, then cancel current timer
-                    if self.events[UID]["start"] != event_start:
-                        self.cancel_timer(self.events[UID]["timer_id"])
-
-                        self.events[UID]["scheduled"] = False
-                        self.events[UID]["timer_id"] = None
-
-            else:
-                self.events[UID] = {
-                    "done": False,
-                    "scheduled": False,
-                    "start": event_start,
-                    "summary": summary,
-                    "timer_id": None,
-                }
-
-            if self.events[UID]["done"]:
+            reminder = self.reminders.get(UID)
+            if reminder is None:
+                reminder = Reminder(UID, event_start, summary)
+                self.reminders.add(reminder)
+            elif not reminder.done and (reminder.start != event_start or reminder.summary != summary):
+                # if event changed, then cancel current timer
+                self.cancel_reminder(reminder)
+                reminder.start = event_start
+                reminder.summary = summary
+
+            if reminder.done:
                 self.tryLog(f"{UID} done")
                 continue
 
-            if self.events[UID]["scheduled"]:
+            if reminder.scheduled:
                 self.tryLog(f"{UID} scheduled")
-                reminder_state_set = True
                 continue
 
-            if current_time <= event_start:
-                # Schedule a reminder task 2 min before it starts
-                remind_at = event_start + timedelta(minutes=-self.reminder_offset)
-                remind_time = remind_at.time()
-                message = Reminders.get_announcement(summary, self.reminder_offset)
-                reminder_sensor_state = f"{message} @{remind_time.strftime('%-I:%M %p')}"
+            self.arm_reminder(reminder, current_time)
 
-                if current_time < remind_at:
-                    self.tryLog(f"Scheduling '{message}' at {remind_time}")
+        self.update_reminder_sensor()
+        self.save_state()
 
-                    # run_once schedules a task for today
-                    timer_id = self.run_once(self.remind, remind_time, message=message, UID=UID)
+    def arm_reminder(self, reminder: Reminder, current_time):
+        """Schedule the reminder or send it right away if its reminder time has passed."""
+        if current_time <= reminder.start:
+            # Schedule a reminder task 2 min before it starts
+            remind_at = reminder.start + timedelta(minutes=-self.reminder_offset)
+            remind_time = remind_at.time()
+            message = Reminders.get_announcement(reminder.summary, self.reminder_offset)
+            reminder.message = message
+            reminder.sensor_state = f"{message} @{remind_time.strftime('%-I:%M %p')}"
 
-                    self.events[UID]["scheduled"] = True
-                    self.events[UID]["timer_id"] = timer_id
-                    self.events[UID]["sensor_state"] = reminder_sensor_state
-                    self.scheduled_event_uids.append(UID)
+            if current_time < remind_at:
+                self.tryLog(f"Scheduling '{message}' at {remind_time}")
 
-                    if not reminder_state_set:
-                        reminder_state_set = True
-                        self.set_reminder_sensor(reminder_sensor_state, UID)
-                else:
-                    # Send reminder right away if we have passed reminder_offset period (this would
-                    # be probably due to app restart). But if there is a reminder scheduled and data
-                    # was reloaded in that 2 minute period, then don't send another reminder right away.
-
-                    if self.get_reminder_sensor_UID() != UID:
-                        self.tryLog(f'Sending reminder right away "{reminder_sensor_state} {UID}"')
-                        self.remind({"message": message, "UID": UID})
+                # run_once schedules a task for today
+                reminder.timer_id = self.run_once(self.remind, remind_time, message=message, UID=reminder.UID)
+                self.reminders.schedule(reminder, remind_at)
             else:
-                self.tryLog(f"Event '{summary}' has passed")
-                self.events[UID]["done"] = True
-                self.events[UID]["scheduled"] = False
+                # Send reminder right away if we have passed reminder_offset period (this would
+                # be probably due to app restart). But if there is a reminder scheduled and data
+                # was reloaded in that 2 minute period, then don't send another reminder right away.
 
-        # No reminder, clear the sensor
-        if not reminder_state_set:
+                if self.get_reminder_sensor_UID() != reminder.UID:
+                    self.tryLog(f'Sending reminder right away "{reminder.sensor_state} {reminder.UID}"')
+                    self.remind({"message": message, "UID": reminder.UID})
+        else:
+            self.tryLog(f"Event '{reminder.summary}' has passed")
+            self.reminders.complete(reminder)
+
+    def update_reminder_sensor(self):
+        """Update the reminder_sensor with the next reminder."""
+        next_reminder = self.reminders.peek()
+        if next_reminder is None:
+            # No reminder, clear the sensor
             self.set_reminder_sensor("None", None)
+        else:
+            self.set_reminder_sensor(next_reminder.sensor_state, next_reminder.UID)
+
+    def save_state(self):
+        """Persist the reminders of the day so that a restart can re-arm them."""
+        data = {
+            "day": self.scheduled_day.isoformat() if self.scheduled_day else None,
+            "reminders": [
+                [reminder.UID, reminder.start.isoformat(), reminder.summary, reminder.done]
+                for reminder in self.reminders
+            ],
+        }
+
+        try:
+            AppUtils.save_json(self.state_file, data)
+        except OSError as error:
+            self.tryLog(f"Error saving state {error}")
+
+    def restore_state(self):
+        """Re-arm the reminders saved by a previous run if they are for today."""
+        data = AppUtils.load_json(self.state_file, {})
+        current_time = self.get_current_instant()
+
+        if data.get("day") != current_time.date().isoformat():
+            return
+
+        # Today might no longer have reminders
+        if self.get_fetch_starting(current_time) != "now":
+            return
+
+        self.tryLog(f"Restoring {len(data['reminders'])} reminders")
+        self.scheduled_day = current_time.date()
+
+        for UID, start, summary, done in data["reminders"]:
+            reminder = Reminder(UID, datetime.fromisoformat(start), summary)
+            self.reminders.add(reminder)
+
+            if done:
+                self.reminders.complete(reminder)
+            else:
+                self.arm_reminder(reminder, current_time)
+
+        self.update_reminder_sensor()
+
+    def update_feeds(self, day: date) -> bool:
+        """
+        Update all feeds concurrently waiting at most feed_timeout. Returns True if any of the feeds changed.
+        A feed still updating keeps its last indexed occurrences and is not updated again until it finishes.
+        """
+        localTZ = pytz.timezone(self.get_timezone())
+
+        feed_changed = False
+        futures = {}
+        for feed in self.feeds:
+            future = self.feed_futures.get(feed)
+            if future is not None and not future.done():
+                self.tryLog(f"Calendar feed {feed.url} is still updating")
+            else:
+                # The update finished after the previous wait timed out
+                if future is not None and self.get_feed_result(feed, future):
+                    feed_changed = True
+
+                future = self.executor.submit(
+                    feed.update, self.session, self.feed_timeout, day, localTZ, offline=self.test_mode
+                )
+                self.feed_futures[feed] = future
+
+            futures[future] = feed
+
+        # The request timeout applies to each read, a trickling download is only bounded by the wait
+        done, not_done = wait(futures, timeout=self.feed_timeout)
+
+        for future in not_done:
+            self.tryLog(f"Timed out getting calendar feed {futures[future].url}")
+
+        for future in done:
+            feed = futures[future]
+            if self.get_feed_result(feed, future):
+                feed_changed = True
+
+        return feed_changed
+
+    def get_feed_result(self, feed: CalendarFeed, future) -> bool:
+        """Returns the result of the finished update of the feed and forgets its future."""
+        del self.feed_futures[feed]
+
+        try:
+            if future.result():
+                self.tryLog(f"Indexed {feed.url} {feed.hash}")
+                return True
+        except Exception as error:
+            # Continue with the last indexed occurrences of the feed if there are any
+            self.tryLog(f"Error getting calendar feed {feed.url} {error}")
+
+        return False
+
+    def get_merged_events(self, start_time, end_time):
+        """Returns the deduplicated (start, summary, UID) events of all feeds between start_time and end_time."""
+        events = {}
+        for feed in self.feeds:
+            for event in feed.get_occurrences(start_time.date()):
+                event_start, summary, UID = event
+                if not (start_time <= event_start < end_time):
+                    continue
+
+                # The same event can be present in multiple feeds, possibly with a different UID
+                if (UID, event_start) not in events and (summary, event_start) not in events:
+                    events[(UID, event_start)] = event
+                    events[(summary, event_start)] = event
+
+        return sorted(set(events.values()))
 
     def get_reminder_sensor_UID(self):
         """Get the UID associated with the current reminder."""
@@ -363,70 +856,147 @@ class Reminders(hass.Hass):
         )
 
     @ad.app_lock
+    def complete_reminder(self, UID) -> str:
+        """Mark the reminder as done and return the reminder_sensor state for the next one."""
+        reminder = self.reminders.get(UID)
+        if reminder is not None:
+            self.reminders.complete(reminder)
+            self.save_state()
+
+        next_reminder = self.reminders.peek()
+        return "None" if next_reminder is None else next_reminder.sensor_state
+
     def remind(self, kwargs):
         """Invoke services to send reminder notifications. This also updates events structure."""
 
         message = kwargs["message"]
         UID = kwargs["UID"]
 
-        self.events[UID]["done"] = True
-        self.events[UID]["scheduled"] = False
-        self.events[UID]["timer_id"] = None
-
-        reminder_state = "None"
-
-        if self.scheduled_event_uids:
-            # The first item in scheduled_event_uids should be UID
-            self.scheduled_event_uids.pop(0)
-
-            if self.scheduled_event_uids:
-                next_UID = self.scheduled_event_uids[0]
-                reminder_state = self.events[next_UID]["sensor_state"]
+        reminder_state = self.complete_reminder(UID)
 
         self.tryLog(f"Announcing '{message}', next '{reminder_state}'")
 
         if self.test_mode:
             return
 
-        self.call_service("notify/mybot", message=message)
-
-        try:
-            for device in self.alexa_devices:
-                self.call_service(
-                    "notify/alexa_media",
-                    target=device,
-                    data={"type": "announce"},
-                    message=message,
-                )
-        except Exception as e:
-            self.tryLog(f"Error invoking alexa_devices. {e}")
-
-        try:
-            for device in self.google_devices:
-                self.call_service("tts/google_say", entity_id=device, 
-                                  message=message)
-        except Exception as e:
-            self.tryLog(f"Error invoking google_devices. {e}")
+        self.announce(message)
 
         self.set_state(
             self.reminder_sensor,
             state=reminder_state,
-            attributes={"friendly_name": self.reminder_sensor_friendly_name},
+            attributes={
+                "friendly_name": self.reminder_sensor_friendly_name,
+                "announcements": self.announce_metrics,
+            },
         )
 
+    def get_announce_targets(self):
+        """Returns the (name, service, service data) of all announcement targets."""
+        targets = [("notify/mybot", "notify/mybot", {})]
+
+        for device in self.alexa_devices:
+            targets.append((device, "notify/alexa_media", {"target": device, "data": {"type": "announce"}}))
+
+        for device in self.google_devices:
+            targets.append((device, "tts/google_say", {"entity_id": device}))
+
+        return targets
+
+    def announce(self, message):
+        """Send the message to all targets concurrently, a slow target does not delay the others."""
+        deadline = time.monotonic() + self.announce_timeout
+
+        futures = {}
+        for name, service, data in self.announce_targets:
+            # A target stuck in a previous announcement keeps its worker, skip it rather than queue behind it
+            future = self.announce_futures.get(name)
+            if future is not None and not future.done():
+                self.announce_metrics[name]["failed"] += 1
+                self.tryLog(f"Skipped announcing on busy {name}")
+                continue
+
+            future = self.announce_executor.submit(self.call_announce_service, service, message, data, deadline)
+            self.announce_futures[name] = future
+            futures[future] = name
+
+        done, not_done = wait(futures, timeout=self.announce_timeout)
+
+        for future in not_done:
+            name = futures[future]
+            self.announce_metrics[name]["failed"] += 1
+            self.tryLog(f"Timed out announcing on {name}")
+
+        for future in done:
+            name = futures[future]
+            del self.announce_futures[name]
+            metrics = self.announce_metrics[name]
+
+            try:
+                latency = future.result()
+            except Exception as e:
+                metrics["failed"] += 1
+                self.tryLog(f"Error announcing on {name}. {e}")
+                continue
+
+            latency = round(latency * 1000)
+            metrics["sent"] += 1
+            metrics["last_latency"] = latency
+            # Moving average in milliseconds
+            if metrics["average_latency"] is None:
+                metrics["average_latency"] = latency
+            else:
+                metrics["average_latency"] = round((metrics["average_latency"] * 9 + latency) / 10)
+
+    def call_announce_service(self, service, message, data, deadline) -> float:
+        """
+        Invoke the service retrying with backoff until the deadline. Returns the latency in seconds of the
+        successful call.
+
+        :param float deadline: time.monotonic() after which no retry is attempted
+        """
+        delay = ANNOUNCE_RETRY_DELAY
+
+        for attempt in range(ANNOUNCE_RETRIES + 1):
+            started = time.monotonic()
+            try:
+                self.call_service(service, message=message, **data)
+                return time.monotonic() - started
+            except Exception:
+                # The announcement is already reported as timed out past the deadline
+                if attempt == ANNOUNCE_RETRIES or time.monotonic() + delay >= deadline:
+                    raise
+
+                time.sleep(delay)
+                delay *= 2
+
+    def cancel_reminder(self, reminder: Reminder):
+        """Cancel the timer of a scheduled reminder."""
+        if reminder.timer_id is not None:
+            self.tryLog(f"Cancelling reminder for {reminder.UID}")
+            self.cancel_timer(reminder.timer_id)
+            reminder.timer_id = None
+
+        self.reminders.cancel(reminder)
+
+    def cancel_reminder_timers(self):
+        """Cancel the timers of the scheduled reminders without changing the saved state"""
+        for reminder in self.reminders:
+            if reminder.timer_id is not None:
+                self.cancel_timer(reminder.timer_id)
+                reminder.timer_id = None
+
     def cancel_reminders(self):
-        """Cancel all scheduled reminders"""
+        """Cancel and clear all scheduled reminders and persist the empty day"""
 
-        if self.events:
+        if len(self.reminders):
             self.tryLog("Cancelling current reminders")
 
-            for UID in self.events:
-                if self.events[UID]["timer_id"] is not None:
-                    self.tryLog(f"Cancelling reminder for {UID}")
-                    self.cancel_timer(self.events[UID]["timer_id"])
+            for reminder in self.reminders:
+                self.cancel_reminder(reminder)
 
-        self.events = {}
-        self.scheduled_event_uids = []
+        self.reminders.clear()
+        self.scheduled_day = None
+        self.save_state()
 
     @staticmethod
     def get_announcement(message, reminder_offset):
@@ -450,8 +1020,3 @@ class Reminders(hass.Hass):
             message = f"Hello {person}, you have {activity} in {reminder_offset} minutes."
 
         return message
-
-    @staticmethod
-    def get_starttime(event):
-        """Delegate for sorting Calendar entries by event_start time."""
-        return event["DTSTART"].dt
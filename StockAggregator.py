@@ -1,12 +1,24 @@
 import hassapi as hass
-from datetime import datetime
+import csv
+from datetime import date, datetime, time, timedelta
+import glob
+import hashlib
+import os
+import sqlite3
+import numpy as np
+import pytz
 import AppUtils
 
 #
 # App to calculate gain based on yahoofinance stock sensors.
 #
 # The gain sensor's state represents the gain/loss. It will have these attributes:
-#   "cost_basis": Sum of (purchase_price * quantity)
+#   "cost_basis": Sum of (purchase_price * quantity) of the open lots
+#   "net_invested": Sum of purchases less the sum of sales
+#   "realized_gain": Gain/loss of the sales, also split into "realized_short_term_gain" and "realized_long_term_gain"
+#   "unrealized_gain": Gain/loss of the held stocks, open lots are also split into "unrealized_short_term_gain"
+#       and "unrealized_long_term_gain"
+#   "lot_method": Method used for matching sales against purchases
 #   "day_change": Overall change based on "regularMarketPreviousClose" of individual stocks
 #   "day_change_percent": Overall daily change percentage
 #   "friendly_name": Specified friendly name
@@ -16,6 +28,11 @@ import AppUtils
 #   "trending": Trending status (up/neutral/down)
 #   "unit_of_measurement": Specified Unit of measurement
 #   "previous_close": Total based on "regularMarketPreviousClose" of individual stocks
+#   "mtd_gain", "qtd_gain", "ytd_gain": Gain/loss since the start of the month/quarter/year
+#   "ytd_return_percent": Time weighted return since the start of the year
+#   "ytd_max_drawdown_percent": Maximum drawdown since the start of the year
+#   "updates_executed": Number of updates which changed the totals
+#   "updates_suppressed": Number of sensor changes coalesced into another update or which changed nothing
 
 #
 # Args:
@@ -24,34 +41,580 @@ import AppUtils
 #   friendly_name: Friendly name of the generated entity
 #   unit_of_measurement: Unit of measurement (currency) of the generated entity (default=USD)
 #   decimal_places: Number of decimal places (default=2)
+#   month_start_entity: Entity updated with the market value on the first day of the month
+#   lot_method: Method used for matching sales against purchases fifo/lifo/specific (default=fifo)
 #   entities: List of tracked yahoo finance sensors (required)
 #     - entity: Sensor id e.g. sensor.yahoofinance_xyz (required)
 #       quantity: Number of stocks currently held. Quanity from purchases is used if this is not defined.
+#         Stocks held beyond the open lots have no cost and are short term.
 #       purchases: List of purchases
 #         - quantity: Number of stocks purchased (required)
 #           price: Purchase price (required)
 #           date: Purchase date (%m-%d-%Y) (required)
+#       sales: List of sales, same format as purchases
+#           lot: Purchase date (%m-%d-%Y) of the lot sold, used by the specific lot method
+#
+#   min_update_interval: Minimum seconds between updates while the market is open (default=30)
+#   max_update_latency: Maximum seconds a sensor change waits for an update while the market is open (default=60)
+#
+#   lots_file: CSV file with the lots, used instead of `entities`. The file is checked for changes and
+#     applied without restarting the app. The path is relative to the apps folder. Columns:
+#       portfolio: total_entity of the portfolio, optional if there is a single portfolio
+#       entity: Sensor id (required)
+#       type: buy/sell, or hold for the number of stocks currently held (required)
+#       quantity: Number of stocks (required)
+#       price: Purchase/sale price (required for buy/sell)
+#       date: Purchase/sale date (%m-%d-%Y)
+#       lot: Purchase date (%m-%d-%Y) of the lot sold, used by the specific lot method
+#   lots_file_check_interval: Seconds between checks for lots_file changes (default=60)
+#
+#   portfolios: List of portfolios, each with the above arguments. This allows a single app to track
+#     multiple portfolios, the app level arguments are ignored if this is defined.
 #
 
 
-# Delay after which calculations are performed when sensors change. Since sensors change individually
-# so this prevent duplicate calculations.
+# Delay after which calculations are performed when sensors change while the market is open. Since sensors
+# change individually so this prevent duplicate calculations. Changes are processed right away otherwise.
 UPDATE_BATCH_TIMER = 2
+DEFAULT_MIN_UPDATE_INTERVAL = 30
+DEFAULT_MAX_UPDATE_LATENCY = 60
+
+MARKET_TIMEZONE = pytz.timezone("America/New_York")
+MARKET_OPEN = time(9, 30)
+MARKET_CLOSE = time(16, 0)
+
+DEFAULT_MONTH_START_ENTITY = "sensor.ameriprise_stocks_value_month_start"
+
+DEFAULT_LOTS_FILE_CHECK_INTERVAL = 60
+
+# Minimum minutes between history snapshots of a portfolio
+HISTORY_SNAPSHOT_INTERVAL = 15
+
+# Metrics tracked for each position and portfolio
+(
+    MARKET_VALUE,
+    PREVIOUS_MARKET_VALUE,
+    COST_BASIS,
+    NET_INVESTED,
+    REALIZED_SHORT_TERM,
+    REALIZED_LONG_TERM,
+    UNREALIZED_SHORT_TERM,
+    UNREALIZED_LONG_TERM,
+) = range(8)
+METRIC_COUNT = 8
+
+# Metrics which only depend on the lots
+STATIC_METRICS = [COST_BASIS, NET_INVESTED, REALIZED_SHORT_TERM, REALIZED_LONG_TERM]
+
+LOT_METHODS = ["fifo", "lifo", "specific"]
+
+# Arrays of PortfolioEngine compiled from the lots, only these are cached
+COMPILED_ARRAYS = [
+    "position_portfolio",
+    "position_quantity",
+    "position_static",
+    "lot_position",
+    "lot_quantity",
+    "lot_price",
+    "lot_date",
+]
+
+# Version of the compiled lots cache, bump when the compiled arrays or how they are computed change
+ENGINE_CACHE_VERSION = 2
+
+# Lots held for more than a year are long term
+LONG_TERM_DAYS = 365
+
+# App level arguments which define a portfolio
+PORTFOLIO_ARGS = [
+    "total_entity",
+    "friendly_name",
+    "unit_of_measurement",
+    "decimal_places",
+    "month_start_entity",
+    "lot_method",
+    "entities",
+]
+
+
+def parse_lot_date(value):
+    """Parse lot date (%m-%d-%Y) into numpy datetime64."""
+    if not value:
+        return np.datetime64("NaT")
+    return np.datetime64(datetime.strptime(value, "%m-%d-%Y").date(), "D")
+
+
+def match_lots(purchases, sales, method):
+    """
+    Match sales against purchases using the lot method.
+
+    :param list purchases: (quantity, price, date) of purchases
+    :param list sales: (quantity, price, date, lot date) of sales, lot date is only used by the specific method
+    :param str method: fifo, lifo or specific (falls back to fifo for the quantity not matched by lot date)
+    Returns the open lots as [quantity, price, date] and the realized lots as (quantity, cost, proceeds, purchase
+    date, sale date). Quantity sold in excess of purchases is realized with no cost.
+    """
+    open_lots = [list(purchase) for purchase in sorted(purchases, key=lambda lot: lot[2])]
+    realized = []
+
+    for sale_quantity, sale_price, sale_date, lot_date in sorted(sales, key=lambda lot: lot[2]):
+        if method == "lifo":
+            candidates = open_lots[::-1]
+        elif method == "specific" and not np.isnat(lot_date):
+            candidates = [lot for lot in open_lots if lot[2] == lot_date]
+            candidates += [lot for lot in open_lots if lot[2] != lot_date]
+        else:
+            candidates = open_lots
+
+        for lot in candidates:
+            if sale_quantity <= 0:
+                break
+
+            # Shares cannot be sold before they are purchased
+            if not np.isnat(sale_date) and not np.isnat(lot[2]) and lot[2] > sale_date:
+                continue
+
+            quantity = min(lot[0], sale_quantity)
+            realized.append((quantity, quantity * lot[1], quantity * sale_price, lot[2], sale_date))
+            lot[0] -= quantity
+            sale_quantity -= quantity
+
+        if sale_quantity > 0:
+            realized.append((sale_quantity, 0.0, sale_quantity * sale_price, sale_date, sale_date))
+
+        open_lots = [lot for lot in open_lots if lot[0] > 0]
+
+    return open_lots, realized
+
+
+def is_long_term(purchase_date, sale_date):
+    """Check if the holding period is more than a year, unknown dates are considered short term."""
+    return (purchase_date + np.timedelta64(LONG_TERM_DAYS, "D")) < sale_date
+
+
+def read_lots_file(path, portfolios):
+    """
+    Read and validate the lots file.
+    Returns the symbol definitions (same format as `entities` argument) keyed by portfolio total_entity.
+    """
+    definitions = {portfolio["total_entity"]: {} for portfolio in portfolios}
+
+    def parse_date(value, line):
+        value = (value or "").strip()
+        if value:
+            try:
+                datetime.strptime(value, "%m-%d-%Y")
+            except ValueError:
+                raise Exception(f"{path}:{line}: Invalid date '{value}'")
+        return value
+
+    def parse_number(value, name, line):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            raise Exception(f"{path}:{line}: Invalid {name} '{value}'")
+
+    with open(path, newline="") as f:
+        reader = csv.DictReader(f)
+        missing = {"entity", "type", "quantity"} - set(reader.fieldnames or [])
+        if missing:
+            raise Exception(f"{path}: Missing columns {sorted(missing)}")
+
+        for line, row in enumerate(reader, start=2):
+            portfolio = (row.get("portfolio") or "").strip()
+            if not portfolio and len(portfolios) == 1:
+                portfolio = portfolios[0]["total_entity"]
+            if portfolio not in definitions:
+                raise Exception(f"{path}:{line}: Unknown portfolio '{portfolio}'")
+
+            entity = (row["entity"] or "").strip().lower()
+            if not entity:
+                raise Exception(f"{path}:{line}: Missing entity")
+
+            item = definitions[portfolio].setdefault(entity, {"entity": entity})
+            kind = (row["type"] or "").strip().lower()
+            quantity = parse_number(row["quantity"], "quantity", line)
+
+            if kind == "hold":
+                item["quantity"] = quantity
+            elif kind in ("buy", "sell"):
+                lot = {
+                    "quantity": quantity,
+                    "price": parse_number(row.get("price"), "price", line),
+                    "date": parse_date(row.get("date"), line),
+                }
+                lot_date = parse_date(row.get("lot"), line)
+                if lot_date:
+                    lot["lot"] = lot_date
+                item.setdefault("purchases" if kind == "buy" else "sales", []).append(lot)
+            else:
+                raise Exception(f"{path}:{line}: Invalid type '{kind}'")
+
+    return {portfolio: list(items.values()) for portfolio, items in definitions.items()}
+
+
+class PortfolioEngine:
+    """
+    Lots of all portfolios compiled once into arrays. A position is a symbol within a portfolio. Sales are matched
+    against purchases once, so only the open lots are kept. Totals are the sum of position contributions with a
+    column per metric, they are maintained by applying the change in contribution of the updated symbol.
+    """
+
+    def __init__(self, portfolios):
+        position_portfolio = []
+        position_quantity = []
+        position_static = []
+        self.position_entity = []
+
+        lot_position = []
+        lot_quantity = []
+        lot_price = []
+        lot_date = []
+
+        for portfolio_index, portfolio in enumerate(portfolios):
+            for item in portfolio["entities"]:
+                entity = item["entity"].lower()
+
+                purchases = item.get("purchases")
+                sales = item.get("sales")
+
+                if (purchases is None) and (sales is None):
+                    raise Exception(f"No `purchases` or `sales` defined for {entity}")
+                elif not purchases and not sales:
+                    raise Exception(f"Empty `purchases` and `sales` defined for {entity}")
+
+                purchases = [
+                    (lot["quantity"], lot["price"], parse_lot_date(lot.get("date"))) for lot in purchases or []
+                ]
+                sales = [
+                    (lot["quantity"], lot["price"], parse_lot_date(lot.get("date")), parse_lot_date(lot.get("lot")))
+                    for lot in sales or []
+                ]
+                open_lots, realized = match_lots(purchases, sales, portfolio["lot_method"])
+
+                position = len(self.position_entity)
+                self.position_entity.append(entity)
+                position_portfolio.append(portfolio_index)
+
+                # Use the quantity from purchases, if it is not defined at symbol level.
+                quantity = item.get("quantity")
+                if quantity is None:
+                    quantity = sum(lot[0] for lot in purchases) - sum(lot[0] for lot in sales)
+                position_quantity.append(quantity)
+
+                # Shares held beyond the open lots, e.g. from a quantity override, are a lot with no cost so that
+                # the unrealized gain of the lots adds up to the market value less the cost basis
+                extra_quantity = quantity - sum(lot[0] for lot in open_lots)
+                if extra_quantity != 0:
+                    open_lots.append([extra_quantity, 0.0, np.datetime64("NaT")])
+
+                static = np.zeros(METRIC_COUNT)
+                static[COST_BASIS] = sum(lot[0] * lot[1] for lot in open_lots)
+                static[NET_INVESTED] = sum(lot[0] * lot[1] for lot in purchases) - sum(
+                    lot[0] * lot[1] for lot in sales
+                )
+                for _, cost, proceeds, purchase_date, sale_date in realized:
+                    column = REALIZED_LONG_TERM if is_long_term(purchase_date, sale_date) else REALIZED_SHORT_TERM
+                    static[column] += proceeds - cost
+                position_static.append(static)
+
+                for quantity, price, purchase_date in open_lots:
+                    lot_position.append(position)
+                    lot_quantity.append(quantity)
+                    lot_price.append(price)
+                    lot_date.append(purchase_date)
+
+        count = len(self.position_entity)
+        self.portfolio_count = len(portfolios)
+        self.position_portfolio = np.array(position_portfolio, dtype=np.intp)
+        self.position_quantity = np.array(position_quantity, dtype=float)
+        self.position_static = np.array(position_static, dtype=float).reshape(count, METRIC_COUNT)
+
+        # Open lots
+        self.lot_position = np.array(lot_position, dtype=np.intp)
+        self.lot_quantity = np.array(lot_quantity, dtype=float)
+        self.lot_price = np.array(lot_price, dtype=float)
+        self.lot_date = np.array(lot_date, dtype="datetime64[D]")
+
+        self.reset()
+
+    def save(self, file):
+        """Save the compiled lots, the prices and totals are not saved."""
+        np.savez(
+            file,
+            portfolio_count=self.portfolio_count,
+            position_entity=np.array(self.position_entity, dtype=str),
+            **{name: getattr(self, name) for name in COMPILED_ARRAYS},
+        )
+
+    @classmethod
+    def load(cls, file):
+        """Returns the engine of the compiled lots saved in file."""
+        engine = cls.__new__(cls)
+        with np.load(file, allow_pickle=False) as data:
+            engine.portfolio_count = int(data["portfolio_count"])
+            engine.position_entity = data["position_entity"].tolist()
+            for name in COMPILED_ARRAYS:
+                setattr(engine, name, data[name])
+
+        engine.reset()
+        return engine
+
+    def reset(self):
+        """Initialize the prices, totals and indexes of the compiled lots."""
+        count = len(self.position_entity)
+        self.lot_long_term = np.zeros(len(self.lot_position), dtype=bool)
+        self.day = None
+
+        self.price = np.full(count, np.nan)
+        self.previous_price = np.zeros(count)
+
+        # Contribution of each position to the totals, only positions with known price contribute
+        self.contributions = np.zeros((count, METRIC_COUNT))
+
+        # Running totals indexed by portfolio
+        self.totals = np.zeros((self.portfolio_count, METRIC_COUNT))
+
+        # The same symbol can be part of multiple portfolios
+        self.entity_positions = {}
+        for position, entity in enumerate(self.position_entity):
+            self.entity_positions.setdefault(entity, []).append(position)
+        self.entity_positions = {
+            entity: np.array(positions, dtype=np.intp) for entity, positions in self.entity_positions.items()
+        }
+
+        self.entity_lots = {
+            entity: np.flatnonzero(np.isin(self.lot_position, positions))
+            for entity, positions in self.entity_positions.items()
+        }
+
+    @property
+    def entities(self):
+        return self.entity_positions.keys()
+
+    def set_day(self, day: date):
+        """Update the holding period of the open lots for the day and recompute the totals."""
+        self.day = day
+        self.lot_long_term = is_long_term(self.lot_date, np.datetime64(day, "D"))
+        self.recompute()
+
+    def get_contributions(self, positions, lots):
+        """Returns the contributions of the positions, lots are the open lots of these positions."""
+        contributions = np.zeros((len(positions), METRIC_COUNT))
+        price = self.price[positions]
+        known = ~np.isnan(price)
+
+        quantity = self.position_quantity[positions]
+        contributions[:, MARKET_VALUE] = quantity * price
+        contributions[:, PREVIOUS_MARKET_VALUE] = quantity * self.previous_price[positions]
+        contributions[:, STATIC_METRICS] = self.position_static[positions][:, STATIC_METRICS]
+
+        # Unrealized gain of each open lot, split by holding period
+        lot_rows = np.searchsorted(positions, self.lot_position[lots])
+        lot_gain = self.lot_quantity[lots] * (price[lot_rows] - self.lot_price[lots])
+        long_term = self.lot_long_term[lots]
+        np.add.at(contributions[:, UNREALIZED_LONG_TERM], lot_rows[long_term], lot_gain[long_term])
+        np.add.at(contributions[:, UNREALIZED_SHORT_TERM], lot_rows[~long_term], lot_gain[~long_term])
+
+        contributions[~known] = 0
+        return contributions
+
+    def update(self, entity, price, previous_price):
+        """
+        Update the current and previous close price of the symbol, price is None if it is unknown. Only the change
+        in the symbol's contribution is applied to the running totals.
+        Returns the indexes of the portfolios whose totals changed.
+        """
+        positions = self.entity_positions[entity]
+        price = np.nan if price is None else price
+
+        current_price = self.price[positions[0]]
+        if (current_price == price or (np.isnan(current_price) and np.isnan(price))) and (
+            self.previous_price[positions[0]] == previous_price
+        ):
+            return []
+
+        self.price[positions] = price
+        self.previous_price[positions] = previous_price
+
+        contributions = self.get_contributions(positions, self.entity_lots[entity])
+        portfolios = self.position_portfolio[positions]
+        np.add.at(self.totals, portfolios, contributions - self.contributions[positions])
+        self.contributions[positions] = contributions
+
+        return np.unique(portfolios).tolist()
+
+    def get_quantity(self, entity) -> float:
+        """Returns the quantity of the symbol held across all portfolios."""
+        return float(self.position_quantity[self.entity_positions[entity]].sum())
+
+    def get_positions(self, portfolio_index):
+        """Returns the (symbol, price, quantity, market_value) of the positions of the portfolio."""
+        positions = np.flatnonzero(self.position_portfolio == portfolio_index)
+        return [
+            (
+                self.position_entity[position],
+                None if np.isnan(self.price[position]) else float(self.price[position]),
+                float(self.position_quantity[position]),
+                float(self.contributions[position, MARKET_VALUE]),
+            )
+            for position in positions
+        ]
+
+    def get_totals(self, portfolio_index):
+        """Returns the totals of the portfolio keyed by metric index."""
+        return [float(value) for value in self.totals[portfolio_index]]
+
+    def recompute(self):
+        """Recompute all contributions and totals in one vectorized pass, this also discards rounding drift."""
+        positions = np.arange(len(self.position_entity))
+        self.contributions = self.get_contributions(positions, np.arange(len(self.lot_position)))
+
+        self.totals = np.zeros((self.portfolio_count, METRIC_COUNT))
+        np.add.at(self.totals, self.position_portfolio, self.contributions)
+
+
+class PortfolioHistory:
+    """
+    SQLite store of daily portfolio and symbol snapshots, the cost basis of a portfolio snapshot is the net amount
+    invested so that its change is the cash flow. Rows of past days are never modified, the row of the
+    current day is replaced by every snapshot. Rows are keyed by (portfolio, day) so that queries only read the
+    requested range.
+    """
+
+    def __init__(self, path):
+        # Callbacks of an app can run on different threads, access is serialized by the app lock
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS portfolio_snapshots (
+                portfolio TEXT NOT NULL,
+                day TEXT NOT NULL,
+                market_value REAL NOT NULL,
+                cost_basis REAL NOT NULL,
+                PRIMARY KEY (portfolio, day)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS symbol_snapshots (
+                portfolio TEXT NOT NULL,
+                symbol TEXT NOT NULL,
+                day TEXT NOT NULL,
+                price REAL,
+                quantity REAL NOT NULL,
+                market_value REAL NOT NULL,
+                PRIMARY KEY (portfolio, symbol, day)
+            ) WITHOUT ROWID;
+            """
+        )
+
+    def close(self):
+        self.connection.close()
+
+    def record(self, portfolio, day: date, market_value, cost_basis, symbols):
+        """
+        Record the snapshot of the portfolio for the day.
+
+        :param list symbols: (symbol, price, quantity, market_value) of the portfolio symbols
+        """
+        day = day.isoformat()
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO portfolio_snapshots VALUES (?, ?, ?, ?)",
+                (portfolio, day, market_value, cost_basis),
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO symbol_snapshots VALUES (?, ?, ?, ?, ?, ?)",
+                [(portfolio, symbol, day, price, quantity, value) for symbol, price, quantity, value in symbols],
+            )
+
+    def get_base(self, portfolio, start_day: date):
+        """Returns the (market_value, cost_basis) at the end of the day before start_day or None."""
+        row = self.connection.execute(
+            "SELECT market_value, cost_basis FROM portfolio_snapshots WHERE portfolio = ? AND day < ? "
+            "ORDER BY day DESC LIMIT 1",
+            (portfolio, start_day.isoformat()),
+        ).fetchone()
+
+        if row is None:
+            # History starts within the period, use the first snapshot
+            row = self.connection.execute(
+                "SELECT market_value, cost_basis FROM portfolio_snapshots WHERE portfolio = ? AND day >= ? "
+                "ORDER BY day LIMIT 1",
+                (portfolio, start_day.isoformat()),
+            ).fetchone()
+
+        return row
+
+    def get_range(self, portfolio, start_day: date):
+        """Returns market value and cost basis arrays from the day before start_day onwards."""
+        rows = self.connection.execute(
+            "SELECT market_value, cost_basis FROM portfolio_snapshots WHERE portfolio = ? AND day >= "
+            "COALESCE((SELECT MAX(day) FROM portfolio_snapshots WHERE portfolio = ? AND day < ?), ?) "
+            "ORDER BY day",
+            (portfolio, portfolio, start_day.isoformat(), start_day.isoformat()),
+        ).fetchall()
+
+        values = np.array(rows, dtype=float).reshape(-1, 2)
+        return values[:, 0], values[:, 1]
+
+    @staticmethod
+    def get_growth(market_value, cost_basis):
+        """
+        Returns the growth index of time weighted return. Change in cost basis between snapshots is
+        treated as cash flow at the end of the day.
+        """
+        if len(market_value) < 2:
+            return np.ones(len(market_value))
+
+        flows = np.diff(cost_basis)
+        previous = market_value[:-1]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            returns = np.where(previous != 0, (market_value[1:] - flows) / previous, 1.0)
+
+        return np.concatenate(([1.0], np.cumprod(returns)))
+
+    @staticmethod
+    def get_max_drawdown(growth) -> float:
+        """Returns the maximum drawdown percent of the growth index."""
+        if len(growth) == 0:
+            return 0.0
+
+        peaks = np.maximum.accumulate(growth)
+        return float(((growth - peaks) / peaks).min() * 100)
 
 
 class StockAggregator(hass.Hass):
     """Represents the StockAggregator app."""
 
     def initialize(self):
-        self.handle_list = []
+        self.handles = {}  # listen_state handles keyed by entity
         self.callback = None
-        self.entities_map = {}
+        self.lots_file_timer = None
+        self.pending_states = {}
+
+        self.min_update_interval = self.args.get("min_update_interval", DEFAULT_MIN_UPDATE_INTERVAL)
+        self.max_update_latency = self.args.get("max_update_latency", DEFAULT_MAX_UPDATE_LATENCY)
+        self.first_pending_change = None  # Time of the oldest unprocessed change
+        self.last_update = None
+        self.updates_executed = 0
+        self.updates_suppressed = 0
+
+        self.portfolios = self.get_portfolios()
+
+        self.lots_file = self.args.get("lots_file")
+        if self.lots_file:
+            self.lots_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), self.lots_file)
+            self.lots_file_mtime = os.path.getmtime(self.lots_file)
+            self.engine, self.lots_file_hash = self.load_engine()
+
+            interval = self.args.get("lots_file_check_interval", DEFAULT_LOTS_FILE_CHECK_INTERVAL)
+            self.lots_file_timer = self.run_every(self.check_lots_file, f"now+{interval}", interval)
+        else:
+            self.engine = PortfolioEngine(self.portfolios)
 
-        self.entities = self.args["entities"]
-        self.total_entity = self.args["total_entity"]
-        self.friendly_name = self.args.get("friendly_name", "")
-        self.unit_of_measurement = self.args.get("unit_of_measurement", "$").upper()
-        self.decimal_places = self.args.get("decimal_places", 2)
+        self.history = PortfolioHistory(AppUtils.get_storage_path(f"{self.name}.history.sqlite"))
+        self.last_snapshots = {}  # Time of the last snapshot keyed by portfolio index
+        self.period_bases = {}  # (market_value, net_invested) at the start of each period keyed by portfolio index
+        self.history_attributes = {}  # Attributes based on history keyed by portfolio index
 
         # self._skip_updates = False
 
@@ -64,102 +627,232 @@ class StockAggregator(hass.Hass):
             self.cancel_timer(self.callback)
             self.callback = None
 
+        if self.lots_file_timer is not None:
+            self.cancel_timer(self.lots_file_timer)
+            self.lots_file_timer = None
+
+        self.history.close()
+
+    def get_portfolios(self):
+        """Returns the portfolio definitions, a single portfolio can be defined using app level arguments."""
+        portfolios = self.args.get("portfolios")
+        if portfolios is None:
+            portfolios = [{key: self.args[key] for key in PORTFOLIO_ARGS if key in self.args}]
+
+        portfolios = [
+            {
+                "total_entity": portfolio["total_entity"],
+                "friendly_name": portfolio.get("friendly_name", ""),
+                "unit_of_measurement": portfolio.get("unit_of_measurement", "$").upper(),
+                "decimal_places": portfolio.get("decimal_places", 2),
+                "month_start_entity": portfolio.get("month_start_entity", DEFAULT_MONTH_START_ENTITY),
+                "lot_method": portfolio.get("lot_method", "fifo").lower(),
+                "entities": portfolio.get("entities", []),
+            }
+            for portfolio in portfolios
+        ]
+
+        for portfolio in portfolios:
+            if portfolio["lot_method"] not in LOT_METHODS:
+                raise Exception(f"Invalid `lot_method` '{portfolio['lot_method']}', expected one of {LOT_METHODS}")
+
+        return portfolios
+
     def subscribe_entities(self):
         self.log("Subscribing")
 
-        for item in self.entities:
-            entity = item["entity"].lower()
-
-            purchases = item.get("purchases")
-            sales = item.get("sales")
-
-            if (purchases is None) and (sales is None):
-                raise Exception(f"No `purchases` or `sales` defined for {entity}")
-            elif len(purchases) == 0 and len(sales) == 0:
-                raise Exception(f"Empty `purchases` and `sales` defined for {entity}")
-
-            quantity = item.get("quantity")
-            self.entities_map[entity] = (quantity, purchases, sales)
-            self.handle_list.append(
-                self.listen_state(self.entity_change, entity, attribute="all")
-            )
+        for entity in self.engine.entities:
+            self.subscribe_entity(entity)
 
         # Force update
-        self.update_total()
+        self.update_all()
+
+    def subscribe_entity(self, entity):
+        self.handles[entity] = self.listen_state(self.entity_change, entity, attribute="all")
+
+    def load_engine(self):
+        """
+        Returns the engine compiled from lots_file along with the file hash. The compiled lots are cached
+        by the hash of the file, portfolio definitions and ENGINE_CACHE_VERSION.
+        """
+        with open(self.lots_file, "rb") as f:
+            file_hash = hashlib.sha256(f.read()).hexdigest()
+
+        definitions = [{key: value for key, value in p.items() if key != "entities"} for p in self.portfolios]
+        cache_key = hashlib.sha256(f"{ENGINE_CACHE_VERSION}{file_hash}{definitions}".encode()).hexdigest()[:16]
+        cache_file = AppUtils.get_storage_path(f"{self.name}.lots.{cache_key}.npz")
+
+        if os.path.exists(cache_file):
+            try:
+                return PortfolioEngine.load(cache_file), file_hash
+            except Exception as error:
+                # Recompile an unreadable cache
+                self.log(f"Error loading {cache_file}: {error}")
+
+        self.log(f"Compiling {self.lots_file}")
+        entities = read_lots_file(self.lots_file, self.portfolios)
+        for portfolio in self.portfolios:
+            portfolio["entities"] = entities[portfolio["total_entity"]]
+
+        engine = PortfolioEngine(self.portfolios)
+
+        # Only the cache of the current file is kept
+        for path in glob.glob(AppUtils.get_storage_path(f"{self.name}.lots.*")):
+            os.remove(path)
+
+        temp_file = f"{cache_file}.tmp"
+        with open(temp_file, "wb") as f:
+            engine.save(f)
+        os.replace(temp_file, cache_file)
+
+        return engine, file_hash
+
+    def check_lots_file(self, kwargs):
+        """Apply lots_file if it changed."""
+        try:
+            mtime = os.path.getmtime(self.lots_file)
+        except OSError as error:
+            self.log(f"Unable to access {self.lots_file}: {error}")
+            return
+
+        if mtime == self.lots_file_mtime:
+            return
+        self.lots_file_mtime = mtime
+
+        try:
+            engine, file_hash = self.load_engine()
+        except Exception as error:
+            # Keep using the current lots
+            self.log(f"Error loading {self.lots_file}: {error}")
+            return
+
+        if file_hash == self.lots_file_hash:
+            return
+
+        self.log(f"Applying {self.lots_file}")
+        self.lots_file_hash = file_hash
+        self.engine = engine
+
+        # Only subscriptions of the added or removed symbols change
+        entities = set(engine.entities)
+        for entity in list(self.handles):
+            if entity not in entities:
+                self.cancel_listen_state(self.handles.pop(entity))
+                self.pending_states.pop(entity, None)
+
+        for entity in entities:
+            if entity not in self.handles:
+                self.subscribe_entity(entity)
+
+        self.period_bases = {}
+        self.update_all()
 
     def entity_change(self, entity, attribute, old, new, kwargs=None):
-        if self.callback is None:
-            # self.log(f"setting callback for {key}")
-            self.callback = self.run_in(self.run_callback, UPDATE_BATCH_TIMER)
-
-    def run_callback(self, kwargs):
-        self.callback = None
-        self.update_total()
-
-    def update_total(self):
-        market_value = float(0)
-        cost_basis = float(0)
-        day_change = float(0)
-        previous_market_value = float(0)
-
-        for entity, (quantity, purchases, sales) in self.entities_map.items():
-            current_price = self.get_state(entity)
-            symbol_attributes = self.get_state(entity, attribute="all")["attributes"]
-
-            if current_price is None:
-                continue
-
-            current_price = AppUtils.to_float(current_price)
-            previous_price = AppUtils.to_float(
-                self.get_state(entity, attribute="regularMarketPreviousClose")
-            )
-
-            quantity_from_purchases = 0
-
-            if purchases:
-                for purchase in purchases:
-                    purchase_quantity = purchase["quantity"]
-                    purchase_price = purchase["price"]
-
-                    purchase_date = purchase.get("date")
-                    if purchase_date:
-                        purchase_date = datetime.strptime(purchase_date, "%m-%d-%Y")
+        # Keep the latest state, only changed symbols are processed
+        self.pending_states[entity] = new
+        now = self.datetime(True)
 
-                    quantity_from_purchases += purchase_quantity
-
-                    # self.log(f"{entity} {purchase_quantity} @ {purchase_price} on {purchase_date.strftime('%-m/%-d/%y')}")
-                    cost_basis += purchase_quantity * purchase_price
-
-            if sales:
-                for sale in sales:
-                    sale_quantity = sale["quantity"]
-                    sale_price = sale["price"]
-
-                    sale_date = sale.get("date")
-                    if sale_date:
-                        sale_date = datetime.strptime(sale_date, "%m-%d-%Y")
+        if self.first_pending_change is None:
+            self.first_pending_change = now
+        else:
+            self.updates_suppressed += 1
 
-                    quantity_from_purchases -= sale_quantity
+        if self.callback is None:
+            # self.log(f"setting callback for {key}")
+            self.callback = self.run_in(self.run_callback, self.get_update_delay(now))
 
-                    # self.log(f"Sold {entity} {sale_quantity} @ {sale_price} on {sale_date.strftime('%-m/%-d/%y')}")
-                    cost_basis -= sale_quantity * sale_price
+    def get_update_delay(self, now) -> float:
+        """Returns seconds after which pending changes are processed."""
+        if not StockAggregator.is_market_open(now):
+            return 0
 
-            # Use the quantity from purchases, if it is not defined at symbol level.
-            if quantity is None:
-                quantity = quantity_from_purchases
+        due = now + timedelta(seconds=UPDATE_BATCH_TIMER)
+        if self.last_update is not None:
+            due = max(due, self.last_update + timedelta(seconds=self.min_update_interval))
+        due = min(due, self.first_pending_change + timedelta(seconds=self.max_update_latency))
 
-            if quantity is None:
-                raise Exception("No `purchases > quantity` or `quantity` defined")
+        return max((due - now).total_seconds(), 0)
 
-            market_value += quantity * current_price
-            previous_market_value += quantity * previous_price
+    @staticmethod
+    def is_market_open(now) -> bool:
+        """Check if the market is open, holidays are not considered."""
+        now = now.astimezone(MARKET_TIMEZONE)
+        return now.weekday() < 5 and MARKET_OPEN <= now.time() < MARKET_CLOSE
 
-            # Save off quantity in attributes
+    def run_callback(self, kwargs):
+        self.callback = None
+        self.first_pending_change = None
+        self.last_update = self.datetime(True)
+
+        pending_states = self.pending_states
+        self.pending_states = {}
+
+        changed_portfolios = set()
+        for entity, state in pending_states.items():
+            changed_portfolios.update(self.update_symbol(entity, state))
+
+        # Lots can become long term with the day
+        if self.engine.day != self.last_update.date():
+            self.engine.set_day(self.last_update.date())
+            changed_portfolios.update(range(len(self.portfolios)))
+
+        if not changed_portfolios:
+            self.updates_suppressed += 1
+            return
+
+        self.updates_executed += 1
+        for index in sorted(changed_portfolios):
+            self.update_portfolio(index)
+
+    def update_all(self):
+        """Update all symbols and portfolios."""
+        for entity in self.engine.entities:
+            self.update_symbol(entity, self.get_state(entity, attribute="all"))
+
+        self.engine.set_day(self.datetime(True).date())
+
+        for index in range(len(self.portfolios)):
+            self.update_portfolio(index)
+
+    def update_symbol(self, entity, state):
+        """Update the symbol from its state. Returns the indexes of the portfolios whose totals changed."""
+        current_price = None if state is None else state["state"]
+        if current_price is None:
+            return self.engine.update(entity, None, 0)
+
+        symbol_attributes = state["attributes"]
+        try:
+            current_price = float(current_price)
+        except ValueError:
+            # e.g. unavailable, the price is unknown rather than 0
+            current_price = None
+        previous_price = AppUtils.to_float(symbol_attributes.get("regularMarketPreviousClose"))
+        changed_portfolios = self.engine.update(entity, current_price, previous_price)
+
+        # Save off quantity in attributes, this is lost whenever the sensor updates
+        quantity = self.engine.get_quantity(entity)
+        if symbol_attributes.get("quantity") != quantity:
+            symbol_attributes = dict(symbol_attributes)
             symbol_attributes["quantity"] = quantity
-            self.set_state(entity, state=current_price, attributes=symbol_attributes)
-
-        gain = market_value - cost_basis
-        gain_percent = ((gain * 100) / cost_basis) if cost_basis != 0 else cost_basis
+            price_state = state["state"] if current_price is None else current_price
+            self.set_state(entity, state=price_state, attributes=symbol_attributes)
+
+        return changed_portfolios
+
+    def update_portfolio(self, index):
+        portfolio = self.portfolios[index]
+        totals = self.engine.get_totals(index)
+        market_value = totals[MARKET_VALUE]
+        previous_market_value = totals[PREVIOUS_MARKET_VALUE]
+        cost_basis = totals[COST_BASIS]
+        net_invested = totals[NET_INVESTED]
+        realized_gain = totals[REALIZED_SHORT_TERM] + totals[REALIZED_LONG_TERM]
+        unrealized_gain = market_value - cost_basis
+        decimal_places = portfolio["decimal_places"]
+
+        # Overall gain including realized gain, this is the same as market value less the net amount invested
+        gain = market_value - net_invested
+        gain_percent = ((gain * 100) / net_invested) if net_invested != 0 else net_invested
         day_change = market_value - previous_market_value
         day_change_percent = (
             ((day_change * 100) / previous_market_value)
@@ -167,7 +860,7 @@ class StockAggregator(hass.Hass):
             else previous_market_value
         )
 
-        self.log(f"gain={gain}")
+        self.log(f"{portfolio['total_entity']} gain={gain}")
 
         # if current_state is not None:
         if market_value < previous_market_value:
@@ -177,49 +870,105 @@ class StockAggregator(hass.Hass):
         else:
             trending = "neutral"
 
+        attributes = self.update_history(index, market_value, net_invested)
+
         # unit_prefix = f" {self.unit_of_measurement}" if self.unit_of_measurement else ""
         market_value = "{:,.2f}".format(
-            AppUtils.round_float(market_value, self.decimal_places)
+            AppUtils.round_float(market_value, decimal_places)
         )
 
         # Round values before setting them
-        attributes = {
+        attributes.update({
             "cost_basis": "{:,.2f}".format(cost_basis),
+            "net_invested": "{:,.2f}".format(net_invested),
+            "realized_gain": "{:+,.2f}".format(realized_gain),
+            "realized_short_term_gain": "{:+,.2f}".format(totals[REALIZED_SHORT_TERM]),
+            "realized_long_term_gain": "{:+,.2f}".format(totals[REALIZED_LONG_TERM]),
+            "unrealized_gain": "{:+,.2f}".format(unrealized_gain),
+            "unrealized_short_term_gain": "{:+,.2f}".format(totals[UNREALIZED_SHORT_TERM]),
+            "unrealized_long_term_gain": "{:+,.2f}".format(totals[UNREALIZED_LONG_TERM]),
+            "lot_method": portfolio["lot_method"],
             "day_change": "{:+,.2f}".format(day_change),
             "day_change_percent": "{:+,.2f}".format(
-                AppUtils.round_float(day_change_percent, self.decimal_places)
+                AppUtils.round_float(day_change_percent, decimal_places)
             )
             + " %",
-            "friendly_name": self.friendly_name,
+            "friendly_name": portfolio["friendly_name"],
             "gain_percent": "{:,.2f}".format(
-                AppUtils.round_float(gain_percent, self.decimal_places)
+                AppUtils.round_float(gain_percent, decimal_places)
             )
             + " %",
             "icon": f"mdi:trending-{trending}",
             "market_value": market_value,
             "trending": trending,
-            "unit_of_measurement": self.unit_of_measurement,
+            "unit_of_measurement": portfolio["unit_of_measurement"],
             "previous_close": "{:,.2f}".format(
-                AppUtils.round_float(previous_market_value, self.decimal_places)
+                AppUtils.round_float(previous_market_value, decimal_places)
             ),
-        }
+            "updates_executed": self.updates_executed,
+            "updates_suppressed": self.updates_suppressed,
+        })
 
         # self.log(attributes)
 
         self.set_state(
-            self.total_entity,
-            state=AppUtils.round_float(gain, self.decimal_places),
+            portfolio["total_entity"],
+            state=AppUtils.round_float(gain, decimal_places),
             attributes=attributes,
             replace=True,
         )
 
         # First day of the month
-        if self.datetime(True).day == 1:
-            self.set_state(
-                "sensor.ameriprise_stocks_value_month_start", state=market_value
+        if portfolio["month_start_entity"] and self.datetime(True).day == 1:
+            self.set_state(portfolio["month_start_entity"], state=market_value)
+
+    def update_history(self, index, market_value, net_invested):
+        """Record a snapshot if one is due and return the attributes based on history."""
+        portfolio_id = self.portfolios[index]["total_entity"]
+        now = self.datetime(True)
+        today = now.date()
+
+        # Market value is understated while a symbol has no price, the snapshot is taken once all prices are known
+        positions = self.engine.get_positions(index)
+        priced = all(price is not None for _, price, _, _ in positions)
+
+        last_snapshot = self.last_snapshots.get(index)
+        if priced and (
+            (last_snapshot is None) or (now - last_snapshot >= timedelta(minutes=HISTORY_SNAPSHOT_INTERVAL))
+        ):
+            self.last_snapshots[index] = now
+            self.history.record(portfolio_id, today, market_value, net_invested, positions)
+
+            year_start = today.replace(month=1, day=1)
+            growth = PortfolioHistory.get_growth(*self.history.get_range(portfolio_id, year_start))
+            self.history_attributes[index] = {
+                "ytd_return_percent": "{:+,.2f}".format((growth[-1] - 1) * 100) + " %",
+                "ytd_max_drawdown_percent": "{:,.2f}".format(PortfolioHistory.get_max_drawdown(growth)) + " %",
+            }
+
+        # Period bases only change with the day
+        bases = self.period_bases.get(index)
+        if bases is None or bases[0] != today:
+            quarter_start = today.replace(month=(today.month - 1) // 3 * 3 + 1, day=1)
+            bases = (
+                today,
+                {
+                    "mtd_gain": self.history.get_base(portfolio_id, today.replace(day=1)),
+                    "qtd_gain": self.history.get_base(portfolio_id, quarter_start),
+                    "ytd_gain": self.history.get_base(portfolio_id, today.replace(month=1, day=1)),
+                },
             )
+            self.period_bases[index] = bases
+
+        gain = market_value - net_invested
+        attributes = dict(self.history_attributes.get(index, {}))
+        for name, base in bases[1].items():
+            if base is not None:
+                attributes[name] = "{:+,.2f}".format(gain - (base[0] - base[1]))
+
+        return attributes
 
     def unsubscribe_entities(self):
-        for handle in self.handle_list:
+        for handle in self.handles.values():
             self.cancel_listen_state(handle)
-        self.handle_list = []
+        self.handles = {}
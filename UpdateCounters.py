@@ -1,17 +1,153 @@
 """App to update group count values"""
 import hassapi as hass
+import bisect
 import datetime
+import fnmatch
+import math
 
 
 # Interval after which count is calculated when an entity change notification is received
 COUNT_UPDATE_BATCH_TIMER = 2
 DEFAULT_BATTERY_THRESHOLD = 25
+DEFAULT_LOWEST_COUNT = 5
+
+AGGREGATES = ["min", "max", "mean", "median", "lowest", "highest", "bands"]
+
+
+class GroupAggregator:
+    """Numeric values of the group members kept in a sorted list
+
+    Members are updated one at a time with a binary search, so aggregates
+    never need to look at all the members again.
+    """
+
+    def __init__(self, aggregates, lowest_count=DEFAULT_LOWEST_COUNT, bands=None):
+        for aggregate in aggregates:
+            if aggregate not in AGGREGATES and not is_percentile(aggregate):
+                raise Exception(f"Unknown aggregate {aggregate}")
+
+        self.aggregates = aggregates
+        self.lowest_count = lowest_count
+        self.bands = sorted(bands or [])
+
+        self.values = {}
+        self.sorted_values = []
+        self.total = 0.0
+
+    def clear(self):
+        self.values = {}
+        self.sorted_values = []
+        self.total = 0.0
+
+    def update(self, entity_id, value):
+        """Set the member value, None removes the member. Returns True if changed"""
+        old_value = self.values.get(entity_id)
+        if old_value == value:
+            return False
+
+        if old_value is not None:
+            index = bisect.bisect_left(self.sorted_values, (old_value, entity_id))
+            del self.sorted_values[index]
+            self.total -= old_value
+            del self.values[entity_id]
+
+        if value is not None:
+            bisect.insort(self.sorted_values, (value, entity_id))
+            self.total += value
+            self.values[entity_id] = value
+
+        return True
+
+    def get_percentile(self, percent):
+        # Nearest rank
+        index = max(0, math.ceil(percent / 100 * len(self.sorted_values)) - 1)
+        return self.sorted_values[index][0]
+
+    def get_bands(self):
+        values = [value for value, entity_id in self.sorted_values]
+        bands = {}
+        lower = None
+        start = 0
+        for threshold in self.bands:
+            end = bisect.bisect_left(values, threshold)
+            name = f"<{threshold}" if lower is None else f"{lower}-{threshold}"
+            bands[name] = end - start
+            lower = threshold
+            start = end
+        if lower is not None:
+            bands[f">={lower}"] = len(values) - start
+        return bands
+
+    def get(self, aggregate):
+        if not self.sorted_values:
+            return {} if aggregate in ("lowest", "highest", "bands") else None
+
+        if aggregate == "min":
+            return self.sorted_values[0][0]
+        if aggregate == "max":
+            return self.sorted_values[-1][0]
+        if aggregate == "mean":
+            return round(self.total / len(self.sorted_values), 2)
+        if aggregate == "median":
+            return self.get_percentile(50)
+        if aggregate == "lowest":
+            return {
+                entity_id: value
+                for value, entity_id in self.sorted_values[: self.lowest_count]
+            }
+        if aggregate == "highest":
+            return {
+                entity_id: value
+                for value, entity_id in reversed(
+                    self.sorted_values[-self.lowest_count :]
+                )
+            }
+        if aggregate == "bands":
+            return self.get_bands()
+        return self.get_percentile(float(aggregate[1:]))
+
+    def get_attributes(self):
+        return {aggregate: self.get(aggregate) for aggregate in self.aggregates}
+
+
+def is_percentile(aggregate):
+    """Percentiles are specified as p<percent>, e.g. p90"""
+    if not aggregate.startswith("p"):
+        return False
+    try:
+        return 0 <= float(aggregate[1:]) <= 100
+    except ValueError:
+        return False
+
+
+def get_numeric(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    # nan and inf would break the sorted values and the running total
+    return value if math.isfinite(value) else None
 
 
 class UpdateCounters(hass.Hass):
     def initialize(self):
-        self.handle_list = []
-        self.callbacks = {}
+        # listen_state handle and whether it listens to all attributes per entity
+        self.handles = {}
+
+        # Resolved member entities per group key
+        self.group_members = {}
+
+        # Reverse index of member entity to the group keys it belongs to and
+        # running count per group, adjusted from the state change callbacks
+        self.entity_groups = {}
+        self.counts = {}
+
+        # Single batch timer for all groups, the groups pending a sensor write
+        # and the last written sensor values to skip unchanged writes
+        self.batch_timer = None
+        self.pending_keys = set()
+        self.reload_pending = False
+        self.published = {}
 
         self.battery_threshold = self.args.get(
             "battery_threshold", DEFAULT_BATTERY_THRESHOLD
@@ -19,110 +155,261 @@ class UpdateCounters(hass.Hass):
         self.groups_map = self.args["groups_map"]
         self.log(self.groups_map)
 
-        self.subscribe_entities()
+        self.aggregators = {}
+        for key, group_map_item in self.groups_map.items():
+            if "aggregates" in group_map_item:
+                self.aggregators[key] = GroupAggregator(
+                    group_map_item["aggregates"],
+                    group_map_item.get("lowest_count", DEFAULT_LOWEST_COUNT),
+                    group_map_item.get("bands"),
+                )
+
+        self.subscribe_entities(self.get_state())
         self.listen_event(self.ha_service_invoked, "call_service")
 
+        # Patterns can match entities added after the groups were resolved
+        if any("include" in item for item in self.groups_map.values()):
+            self.listen_event(self.entity_registry_updated, "entity_registry_updated")
+
         # Groups are created on HASS reconnection which triggers ha_service_invoked updating the counters
         # So we don't need to subscribe to "ha_plugin_started"
 
     def ha_service_invoked(self, event_name, data, kwargs):
-        # Re-subscribe if groups reloaded
+        # Re-subscribe if groups reloaded. Reloads are batched so that a
+        # reconnect storm costs a single state snapshot
         if (data["domain"] == "group") and (data["service"] == "reload"):
-            self.unsubscribe_entities()
-            self.subscribe_entities()
+            self.reload_pending = True
+            self.schedule_batch()
+
+    def entity_registry_updated(self, event_name, data, kwargs):
+        if data.get("action") in ("create", "remove"):
+            self.reload_pending = True
+            self.schedule_batch()
 
     def terminate(self):
         self.unsubscribe_entities()
 
-        if self.callbacks:
-            for key, value in self.callbacks.items():
-                self.cancel_timer(value)
-            self.callbacks = None
+        if self.batch_timer:
+            self.cancel_timer(self.batch_timer)
+            self.batch_timer = None
+
+    def resolve_members(self, key, states):
+        """Member entities of group.<key> and the optional include patterns.
+        Nested groups are expanded recursively and patterns like sensor.*_battery
+        are matched against all entities"""
+        members = {}
+        visited = set()
+
+        def expand(entity_id):
+            if entity_id in visited:
+                return
+            visited.add(entity_id)
+
+            if any(char in entity_id for char in "*?["):
+                for match in fnmatch.filter(states.keys(), entity_id):
+                    expand(match)
+                return
+
+            if entity_id.startswith("group."):
+                group_state = states.get(entity_id)
+                if group_state:
+                    for member in group_state["attributes"].get("entity_id") or []:
+                        expand(member)
+                return
 
-    def subscribe_entities(self):
+            members[entity_id] = None
+
+        expand("group." + key)
+        for pattern in self.groups_map[key].get("include", []):
+            expand(pattern)
+
+        # dict keeps the member order
+        return list(members)
+
+    def subscribe_entities(self, states):
         self.log("Subscribing")
+        self.entity_groups = {}
         for key in self.groups_map:
-            group_id = "group." + key
-            group_attributes = self.get_state(group_id, attribute="all")
-            if group_attributes is None:
+            entities = self.resolve_members(key, states)
+
+            # Groups with include patterns are published even when nothing
+            # matches, so that their sensor drops to 0 when the last match goes
+            group_map_item = self.groups_map[key]
+            if (
+                not entities
+                and "group." + key not in states
+                and "include" not in group_map_item
+            ):
                 continue
 
-            entities = group_attributes["attributes"]["entity_id"]
-            if entities:
+            old_entities = self.group_members.get(key)
+            if old_entities is not None and old_entities != entities:
+                self.log(
+                    f"{key} members changed from {len(old_entities)} to {len(entities)}"
+                )
+            self.group_members[key] = entities
+
+            for entity_id in entities:
+                self.entity_groups.setdefault(entity_id, []).append(key)
+
+            # Full recount is only needed when the group membership is (re)loaded
+            self.counts[key] = self.get_count(states, entities, group_map_item)
+
+            aggregator = self.aggregators.get(key)
+            if aggregator:
+                aggregator.clear()
                 for entity_id in entities:
-                    # self.log("listen_state {%s}", entity_id)
-                    self.handle_list.append(
-                        self.listen_state(
-                            self.entity_change,
-                            entity_id,
-                            key=key,
-                        )
+                    aggregator.update(
+                        entity_id,
+                        self.get_value(states.get(entity_id), group_map_item),
                     )
 
-            # Force update based on the first group item
-            self.entity_change("", "", "", "", {"key": key})
+            self.pending_keys.add(key)
+
+        # Only subscribe and unsubscribe the membership changes, keeping the
+        # existing handles. One subscription per entity even if it is a member
+        # of multiple groups
+        for entity_id in list(self.handles):
+            if entity_id not in self.entity_groups:
+                self.cancel_listen_state(self.handles.pop(entity_id)[0])
+
+        added = 0
+        for entity_id, keys in self.entity_groups.items():
+            # Entities aggregating an attribute need the full state in the callback
+            listen_all = any("attribute" in self.groups_map[key] for key in keys)
+
+            handle = self.handles.get(entity_id)
+            if handle:
+                if handle[1] == listen_all:
+                    continue
+                self.cancel_listen_state(handle[0])
+
+            # self.log("listen_state {%s}", entity_id)
+            if listen_all:
+                handle = self.listen_state(
+                    self.entity_change, entity_id, attribute="all"
+                )
+            else:
+                handle = self.listen_state(self.entity_change, entity_id)
+            self.handles[entity_id] = (handle, listen_all)
+            added += 1
+
+        self.log(f"Subscribed {added} entities, {len(self.handles)} total")
+        self.schedule_batch()
 
     def entity_change(self, entity, attribute, old, new, kwargs):
-        key = kwargs["key"]
+        if attribute == "all":
+            new_entity_state = new
+            old = old["state"] if old else None
+            new = new["state"] if new else None
+        else:
+            new_entity_state = {"state": new, "attributes": {}}
 
-        # Entities in a group can change quicky so use a 2 second timer for count
-        if key not in self.callbacks:
-            # self.log(f"setting callback for {key}")
-            self.callbacks[key] = self.run_in(
-                self.run_callback, COUNT_UPDATE_BATCH_TIMER, key=key
+        for key in self.entity_groups.get(entity, []):
+            group_map_item = self.groups_map[key]
+            changed = False
+
+            delta = self.is_match(new, group_map_item) - self.is_match(
+                old, group_map_item
             )
+            if delta:
+                self.counts[key] += delta
+                changed = True
 
-    def run_callback(self, kwargs):
-        key = kwargs["key"]
+            aggregator = self.aggregators.get(key)
+            if aggregator and aggregator.update(
+                entity, self.get_value(new_entity_state, group_map_item)
+            ):
+                changed = True
 
-        del self.callbacks[key]
+            if changed:
+                self.pending_keys.add(key)
+                self.schedule_batch()
 
-        group_id = "group." + key
-        self.update_count(group_id, self.groups_map[key])
+    def schedule_batch(self):
+        # Entities in a group can change quicky so use a 2 second timer for count
+        if self.batch_timer is None:
+            self.batch_timer = self.run_in(self.run_batch, COUNT_UPDATE_BATCH_TIMER)
 
-    def update_count(self, group_id, group_map_item):
-        # self.log(group_id)
-        entity_list = self.get_state(group_id, attribute="all")["attributes"][
-            "entity_id"
-        ]
+    def run_batch(self, kwargs):
+        self.batch_timer = None
 
-        # count_sensor = "variable." + group_map_item["sensor"]
-        count_sensor = "sensor." + group_map_item["sensor"]
+        if self.reload_pending:
+            self.reload_pending = False
+
+            # Sensors are recreated on HASS reconnection, so write them all
+            self.published = {}
+            self.subscribe_entities(self.get_state())
+
+            # subscribe_entities scheduled another batch for the new counts
+            return
 
+        pending_keys = self.pending_keys
+        self.pending_keys = set()
+        for key in pending_keys:
+            self.update_count(key, self.groups_map[key])
+
+    def is_match(self, state, group_map_item):
+        if group_map_item.get("battery"):
+            # Safeguard against uninitialized entity
+            if state is None or state == "unavailable":
+                return False
+            try:
+                return int(state) < self.battery_threshold
+            except ValueError:
+                return False
+
+        return state == group_map_item.get("state")
+
+    def get_value(self, entity_state, group_map_item):
+        """Numeric value of the member for the aggregates, None if not numeric"""
+        if not entity_state:
+            return None
+        if "attribute" in group_map_item:
+            return get_numeric(
+                entity_state["attributes"].get(group_map_item["attribute"])
+            )
+        return get_numeric(entity_state["state"])
+
+    def get_count(self, states, entity_list, group_map_item):
         count = 0
         if entity_list:
-            if group_map_item.get("battery"):
-                for entity_id in entity_list:
-                    batteryState = self.get_state(entity_id)
-                    #self.log("batteryState %s=%s", entity_id, batteryState)
-
-                    # Safeguard against uninitialized entity
-                    if not (batteryState is None) and not (
-                        batteryState == "unavailable"
-                    ):
-                        if int(batteryState) < self.battery_threshold:
-                            count = count + 1
-            else:
-                matchValue = group_map_item.get("state")
+            for entity_id in entity_list:
+                entity_state = states.get(entity_id)
+                state = entity_state["state"] if entity_state else None
+                if self.is_match(state, group_map_item):
+                    count = count + 1
+        return count
 
-                # self.log(entity_list)
-                for entity_id in entity_list:
-                    if self.get_state(entity_id) == matchValue:
-                        count = count + 1
+    def update_count(self, key, group_map_item):
+        # count_sensor = "variable." + group_map_item["sensor"]
+        count_sensor = "sensor." + group_map_item["sensor"]
+        count = self.counts[key]
 
         new_attributes = {"friendly_name": group_map_item["friendly_name"]}
 
         if "icon" in group_map_item:
             new_attributes["icon"] = "mdi:" + group_map_item["icon"]
 
+        aggregator = self.aggregators.get(key)
+        if aggregator:
+            new_attributes.update(aggregator.get_attributes())
+
+            # Groups without a state to count report their first aggregate
+            if "state" not in group_map_item and not group_map_item.get("battery"):
+                count = new_attributes[aggregator.aggregates[0]]
+
+        if self.published.get(count_sensor) == (count, new_attributes):
+            return
+        self.published[count_sensor] = (count, new_attributes)
+
         self.set_state(count_sensor, state=count, attributes=new_attributes)
         #self.log("Counter %s = %d", count_sensor, count)
 
     def unsubscribe_entities(self):
-        if self.handle_list:
-            for handle in self.handle_list:
-                self.cancel_listen_state(handle)
-        self.handle_list = []
+        for handle, listen_all in self.handles.values():
+            self.cancel_listen_state(handle)
+        self.handles = {}
 
     def log_notify(self, message, level="INFO"):
         if "verbose_log" in self.args:
@@ -1,132 +1,577 @@
 import hassapi as hass
 import datetime
-from dateutil.parser import parse
-import copy
+import hashlib
+import json
+import numpy as np
+from collections import Counter
+import AppUtils
 
 #
 # App to update weather entity based on NWS weather daynight entity
+# and optionally other forecast sources merged into one forecast
 #
 # Args:
 #
 # source = NWS daynight entity
+# sources = List of forecast sources to merge instead of a single source
+#   entity = Source weather entity
+#   weight = Weight of the numeric values of the source (default = 1)
+#   forecast_type = twice_daily (NWS daynight), daily or hourly (default = twice_daily)
+#   aggregations = Per field aggregation of the source, overriding the app aggregations
+# precedence = Per field list of source entities to take the value from in that order, e.g.
+#   condition: [weather.openweathermap, weather.kmsn_daynight]
+#   Fields without precedence use the weighted mean if numeric, else the sources order
+# station = Local sensor per current condition field, overriding the sources, e.g.
+#   temperature: sensor.outdoor_temperature
+# aggregations = Per field aggregation overriding DEFAULT_AGGREGATIONS of the forecast_type
+#   when rolling up the periods of a day, one of min, max, sum, mean, first or mode,
+#   e.g. wind_speed: max
 # destination = Generated weather entity
+# hourly_destination = Generated hourly weather entity (optional)
 #
+# The last good forecast of each source is saved in the storage folder. It is used
+# when a source is unavailable and to update the destinations right after a
+# restart, with the past periods removed and stale attributes set.
+#
+
+FORECAST_TYPES = ["twice_daily", "daily", "hourly"]
+
+# Fields merged using the weighted mean of the sources unless they have a precedence
+NUMERIC_FIELDS = [
+    "temperature",
+    "templow",
+    "apparent_temperature",
+    "dew_point",
+    "humidity",
+    "pressure",
+    "precipitation",
+    "precipitation_probability",
+    "cloud_coverage",
+    "uv_index",
+    "visibility",
+    "wind_speed",
+    "wind_gust_speed",
+]
+
+# Aggregation used when rolling up the periods of a day into the daily forecast,
+# fields not listed use the first period value and fields set to None are dropped.
+# Other aggregations, e.g. temperature: max or precipitation: sum, are set with aggregations
+AGGREGATIONS = ["min", "max", "sum", "mean", "first", "mode"]
+DAILY_AGGREGATIONS = {
+    "templow": "min",
+    "precipitation_probability": "max",
+    "is_daytime": None,
+    "detailed_description": None,
+}
+
+# The first hour is not representative of the day, hourly periods are rolled up
+# into the high, low, totals and most common condition of the day
+HOURLY_AGGREGATIONS = dict(
+    DAILY_AGGREGATIONS,
+    condition="mode",
+    temperature="max",
+    apparent_temperature="max",
+    dew_point="mean",
+    humidity="mean",
+    pressure="mean",
+    precipitation="sum",
+    cloud_coverage="mean",
+    uv_index="max",
+    wind_speed="mean",
+    wind_gust_speed="max",
+)
+
+DEFAULT_AGGREGATIONS = {
+    "twice_daily": DAILY_AGGREGATIONS,
+    "daily": DAILY_AGGREGATIONS,
+    "hourly": HOURLY_AGGREGATIONS,
+}
+
+# Period fields used for a daily field when the period does not have it
+FALLBACK_FIELDS = {"templow": "temperature"}
+
+# Bucket key of the current conditions of the sources
+CURRENT = "current"
+
+
+def get_numeric(value):
+    """Numeric value of a field, NWS values can be a dict with value and unitCode"""
+    if isinstance(value, dict):
+        value = value.get("value")
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_datetime(datetime_string):
+    # fromisoformat only accepts the Z suffix from Python 3.11
+    if datetime_string.endswith("Z"):
+        datetime_string = datetime_string[:-1] + "+00:00"
+    return datetime.datetime.fromisoformat(datetime_string)
+
+
+def aggregate_periods(periods, aggregations):
+    """Roll up the periods of a day into a daily forecast in a single pass"""
+    values = {}
+    for period in periods:
+        for field, value in period.items():
+            values.setdefault(field, []).append(value)
+        for field, fallback_field in FALLBACK_FIELDS.items():
+            if field not in period and fallback_field in period:
+                values.setdefault(field, []).append(period[fallback_field])
+
+    daily_forecast = {}
+    for field, field_values in values.items():
+        aggregation = aggregations.get(field, "first")
+        if aggregation is None:
+            continue
+
+        if aggregation == "first":
+            daily_forecast[field] = field_values[0]
+            continue
+        if aggregation == "mode":
+            daily_forecast[field] = Counter(field_values).most_common(1)[0][0]
+            continue
+
+        numbers = []
+        for value in field_values:
+            number = get_numeric(value)
+            if number is not None:
+                # Keep the period value for min and max without the unit
+                if isinstance(value, dict):
+                    value = value["value"]
+                numbers.append((number, value))
+
+        if not numbers:
+            daily_forecast[field] = None
+        elif aggregation == "min":
+            daily_forecast[field] = min(numbers, key=lambda item: item[0])[1]
+        elif aggregation == "max":
+            daily_forecast[field] = max(numbers, key=lambda item: item[0])[1]
+        else:
+            total = sum(number for number, value in numbers)
+            if aggregation == "sum":
+                daily_forecast[field] = round(total, 2)
+            else:
+                daily_forecast[field] = round(total / len(numbers), 1)
+
+    return daily_forecast
+
+
+def fuse_buckets(keys, bucket_maps, weights, field_orders, default_order):
+    """Fuse the forecasts of each bucket key from all sources.
+
+    bucket_maps has a dict of bucket key to forecast for each source. Numeric fields
+    are combined with the weighted mean of the sources having a value in a single
+    array pass for all keys. Other fields and fields in field_orders are taken from
+    the first source having them in the field order.
+    """
+    fused = {}
+    if not keys:
+        return fused
+
+    source_count = len(bucket_maps)
+    key_count = len(keys)
+
+    means = {}
+    counts = {}
+    for field in NUMERIC_FIELDS:
+        if field in field_orders:
+            continue
+
+        values = np.full((source_count, key_count), np.nan)
+        for source_index, bucket_map in enumerate(bucket_maps):
+            for key_index, key in enumerate(keys):
+                forecast = bucket_map.get(key)
+                if forecast is not None and field in forecast:
+                    value = get_numeric(forecast[field])
+                    if value is not None:
+                        values[source_index, key_index] = value
+
+        present = ~np.isnan(values)
+        if not present.any():
+            continue
+
+        field_weights = weights[:, None] * present
+        total_weights = field_weights.sum(axis=0)
+        totals = (np.where(present, values, 0) * field_weights).sum(axis=0)
+        means[field] = np.divide(
+            totals, total_weights, out=np.zeros(key_count), where=total_weights > 0
+        )
+        counts[field] = present.sum(axis=0)
+
+    for key_index, key in enumerate(keys):
+        forecasts = [bucket_map.get(key) for bucket_map in bucket_maps]
+        if not any(forecasts):
+            continue
+
+        forecast = {}
+        for source_index in default_order:
+            if forecasts[source_index]:
+                for field, value in forecasts[source_index].items():
+                    forecast.setdefault(field, value)
+
+        for field, order in field_orders.items():
+            for source_index in order:
+                if forecasts[source_index] and field in forecasts[source_index]:
+                    forecast[field] = forecasts[source_index][field]
+                    break
+
+        # Keep the value of a single source as is to avoid float conversion
+        for field, mean in means.items():
+            if counts[field][key_index] > 1:
+                forecast[field] = round(float(mean[key_index]), 1)
+
+        fused[key] = forecast
+
+    return fused
+
+
+class ForecastSource:
+    """Forecast of a single source entity bucketed by day and by hour"""
+
+    def __init__(self, entity, weight, forecast_type, aggregations):
+        if forecast_type not in FORECAST_TYPES:
+            raise Exception(f"{entity}: unknown forecast_type {forecast_type}")
+
+        self.entity = entity
+        self.weight = weight
+        self.forecast_type = forecast_type
+
+        # Aggregations used when rolling up the periods of a day
+        self.aggregations = dict(DEFAULT_AGGREGATIONS[forecast_type], **aggregations)
+        for field, aggregation in self.aggregations.items():
+            if aggregation is not None and aggregation not in AGGREGATIONS:
+                raise Exception(f"{entity}: aggregations {field}: unknown aggregation {aggregation}")
+
+        # Hash of the last source state, current conditions, daily forecasts
+        # keyed by date with the periods they were rolled up from, hourly
+        # forecasts keyed by hour and the date and hour keys of each period
+        # datetime string
+        self.source_hash = None
+        self.current = None
+        self.daily_periods = {}
+        self.daily = {}
+        self.hourly = {}
+        self.period_keys = {}
+
+        # Time of the last good forecast and whether the buckets are from
+        # the cache instead of the source entity
+        self.updated = None
+        self.stale = False
 
 
 class UpdateNWS(hass.Hass):
     def initialize(self):
-        self.source_entity = self.args["source"]
         self.destination_entity = self.args["destination"]
+        self.hourly_destination_entity = self.args.get("hourly_destination")
+
+        source_args = self.args.get("sources")
+        if source_args is None:
+            source_args = [{"entity": self.args["source"]}]
+
+        aggregations = self.args.get("aggregations", {})
+        self.sources = [
+            ForecastSource(
+                source_arg["entity"],
+                source_arg.get("weight", 1),
+                source_arg.get("forecast_type", "twice_daily"),
+                dict(aggregations, **source_arg.get("aggregations", {})),
+            )
+            for source_arg in source_args
+        ]
+        self.weights = np.array([source.weight for source in self.sources], float)
+
+        source_indexes = {source.entity: index for index, source in enumerate(self.sources)}
+        self.default_order = list(range(len(self.sources)))
+        self.field_orders = {}
+        for field, entities in self.args.get("precedence", {}).items():
+            for entity in entities:
+                if entity not in source_indexes:
+                    raise Exception(f"precedence {field}: {entity} is not a source")
+            self.field_orders[field] = [source_indexes[entity] for entity in entities]
+
+        self.station = self.args.get("station", {})
+
+        # Fused forecasts keyed by bucket and the last written destination states
+        self.fused_daily = {}
+        self.fused_hourly = {}
+        self.destination_states = {}
+
+        self.cache_file = AppUtils.get_storage_path(f"{self.name}.forecast.json")
+        self.restore_cache()
+        self.update_destinations()
 
-        self.listen_state(self.state_change, self.source_entity)
-        self.update_from_nws()
+        # Remove the past periods of stale sources
+        self.run_hourly(self.prune_callback, datetime.time(minute=0, second=5))
+
+        # Forecast attributes can change without a state change
+        for source in self.sources:
+            self.listen_state(
+                self.state_change, source.entity, attribute="all", source=source
+            )
+        for entity in self.station.values():
+            self.listen_state(self.station_change, entity)
+
+        changed = False
+        for source in self.sources:
+            changed = self.update_source(source) or changed
+        if changed:
+            self.save_cache()
+            self.update_destinations()
 
     def state_change(self, entity, attribute, old, new, kwargs):
-        self.log("NWS entity changed")
-        self.update_from_nws()
+        self.log(f"{entity} changed")
+        if self.update_source(kwargs["source"]):
+            self.save_cache()
+            self.update_destinations()
 
-    def update_from_nws(self):
-        attributes = self.get_state(self.source_entity, attribute="all")[
-            "attributes"
-        ]
+    def station_change(self, entity, attribute, old, new, kwargs):
+        self.update_destinations()
 
-        forecast_list = attributes.get("forecast")
-        if forecast_list is None:  # forecast can sometimes is missing
-            return
+    def prune_callback(self, kwargs):
+        if self.prune_stale_sources():
+            self.update_destinations()
 
-        new_forecasts = {}
-        # self.log(f'forecast_list={forecast_list}')
-        first_temperature = None
+    def update_source(self, source):
+        """Bucket the source forecast and fuse the buckets it changed.
+        Returns True if the source changed"""
+        source_state = self.get_state(source.entity, attribute="all")
+        forecast_list = None
+        if source_state is not None:
+            attributes = source_state["attributes"]
+            forecast_list = attributes.get("forecast")
 
-        for forecast in forecast_list:
-            datetime = parse(forecast["datetime"])
-            date = datetime.date()
+        # forecast can sometimes is missing, keep using the last good forecast
+        if forecast_list is None:
+            if source.stale or source.current is None:
+                return False
+            self.log(f"{source.entity} is unavailable, using the last forecast")
+            source.stale = True
 
-            # Convert to midnight
-            date = datetime.combine(date, datetime.min.time())
+            # The same forecast as before the outage must clear the stale state
+            source.source_hash = None
+            self.prune_stale_sources()
+            return True
 
-            date_string = date.astimezone().isoformat()
+        # Nothing to do if the source did not change since the last update
+        source_hash = hashlib.sha1(
+            json.dumps(
+                [source_state["state"], attributes], sort_keys=True, default=str
+            ).encode()
+        ).hexdigest()
+        if source_hash == source.source_hash:
+            return False
+        source.source_hash = source_hash
 
-            if date_string in new_forecasts:
-                # self.log(f'existing new_forecasts[{date_string}]= {new_forecasts[date_string]}')
+        source.current = {
+            key: value for key, value in attributes.items() if key != "forecast"
+        }
+        source.current["condition"] = source_state["state"]
+        source.updated = datetime.datetime.now().astimezone().isoformat()
+        source.stale = False
 
-                self.set_templow(new_forecasts[date_string], forecast)
-                self.combine_precipitation(
-                    new_forecasts[date_string], forecast
+        # Bucket the periods by day and hour in a single pass, parsing each
+        # period datetime only once while it is in the forecast
+        period_keys = {}
+        periods_by_date = {}
+        hourly = {}
+        for forecast in forecast_list:
+            datetime_string = forecast["datetime"]
+            keys = source.period_keys.get(datetime_string)
+            if keys is None:
+                period_datetime = parse_datetime(datetime_string)
+                keys = (
+                    self.get_date_string(period_datetime),
+                    self.get_hour_string(period_datetime),
                 )
-            else:
-                new_forecasts[date_string] = copy.deepcopy(forecast)
-                # self.log(f'new_forecasts[{date_string}]= {new_forecasts[date_string]}')
+            period_keys[datetime_string] = keys
 
-                # Use the temperature as the templow
-                new_forecasts[date_string]["templow"] = forecast["temperature"]
+            date_string, hour_string = keys
+            periods_by_date.setdefault(date_string, []).append(forecast)
+            if source.forecast_type == "hourly":
+                hourly.setdefault(hour_string, forecast)
+        source.period_keys = period_keys
 
-                if first_temperature is None:
-                    first_temperature = forecast["temperature"]
+        if source.forecast_type == "hourly":
+            changed_hours = self.get_changed_keys(source.hourly, hourly)
+            source.hourly = hourly
+            self.fuse(self.fused_hourly, changed_hours, "hourly")
 
-                # new_forecasts[date_string]["datetime"] = date_string
-                del new_forecasts[date_string]["is_daytime"]
-                del new_forecasts[date_string]["detailed_description"]
+        # Roll up only the days whose periods changed
+        daily_periods = {}
+        daily = {}
+        for date_string, periods in periods_by_date.items():
+            if source.daily_periods.get(date_string) == periods:
+                daily[date_string] = source.daily[date_string]
+            else:
+                daily[date_string] = aggregate_periods(periods, source.aggregations)
+            daily_periods[date_string] = periods
+        changed_dates = self.get_changed_keys(source.daily, daily)
+        source.daily_periods = daily_periods
+        source.daily = daily
 
-        # self.log(f'new_forecasts={new_forecasts}')
+        self.fuse(self.fused_daily, changed_dates, "daily")
+        return True
 
-        # Copy entity attributes and then delete previous forecast
-        new_attributes = copy.deepcopy(attributes)
-        del new_attributes["forecast"]
-        # del new_attributes["friendly_name"]  #Keep friendly name
-        new_attributes["forecast"] = list(new_forecasts.values())
+    def get_changed_keys(self, old_buckets, new_buckets):
+        return [
+            key
+            for key in old_buckets.keys() | new_buckets.keys()
+            if old_buckets.get(key) != new_buckets.get(key)
+        ]
 
-        # Use the first temperature as the temperature if it is missing
-        new_attributes["temperature"] = new_attributes.get(
-            "temperature", first_temperature
+    def fuse(self, fused_buckets, keys, bucket_type):
+        """Recompute the fused forecast for the given bucket keys"""
+        fused = fuse_buckets(
+            keys,
+            [getattr(source, bucket_type) for source in self.sources],
+            self.weights,
+            self.field_orders,
+            self.default_order,
         )
+        for key in keys:
+            if key in fused:
+                fused_buckets[key] = fused[key]
+            else:
+                fused_buckets.pop(key, None)
 
-        # self.log(new_attributes)
+    def prune_stale_sources(self):
+        """Remove the buckets before the current day or hour from the stale
+        sources. Returns True if any bucket was removed"""
+        now = datetime.datetime.now().astimezone()
+        date_string = self.get_date_string(now)
+        hour_string = self.get_hour_string(now)
 
-        self.set_state(
-            self.destination_entity,
-            state=self.get_state(self.source_entity),
-            attributes=new_attributes,
-            replace=True,
-        )
+        pruned = False
+        for source in self.sources:
+            if not source.stale:
+                continue
 
-    def set_templow(self, daily_forecast, forecast):
-        previous_value = daily_forecast.get("temperature", None)
-        if previous_value is None:
-            return
+            for bucket_type, fused_buckets, first_key in (
+                ("daily", self.fused_daily, date_string),
+                ("hourly", self.fused_hourly, hour_string),
+            ):
+                buckets = getattr(source, bucket_type)
+                past_keys = [key for key in buckets if key < first_key]
+                for key in past_keys:
+                    del buckets[key]
+                    source.daily_periods.pop(key, None)
+                if past_keys:
+                    self.fuse(fused_buckets, past_keys, bucket_type)
+                    pruned = True
 
-        value = forecast.get("temperature", None)
-        if value is None:
-            return
+        return pruned
 
-        # self.log(f'set_templow {previous_value} {value}')
-        daily_forecast["templow"] = min(previous_value, value)
+    def save_cache(self):
+        """Persist the last good forecast of each source"""
+        data = {
+            source.entity: {
+                "updated": source.updated,
+                "current": source.current,
+                "daily": source.daily,
+                "hourly": source.hourly,
+            }
+            for source in self.sources
+            if source.current is not None
+        }
 
-    def extract_precipitation(self, value):
-        if value is None:
-            return None
+        try:
+            AppUtils.save_json(self.cache_file, data)
+        except (OSError, TypeError, ValueError) as error:
+            self.log(f"Error saving forecast cache {error}")
 
-        if isinstance(value, dict):
-            return value.get("value", None)
+    def restore_cache(self):
+        """Load the forecasts saved by a previous run as stale sources"""
+        data = AppUtils.load_json(self.cache_file, {})
 
-        return value
+        for source in self.sources:
+            source_data = data.get(source.entity)
+            if not source_data:
+                continue
 
-    def combine_precipitation(self, daily_forecast, forecast):
-        #Sample values:
-        #precipitation_probability:
-        #    unitCode: wmoUnit:percent
-        #    value: null
-        #precipitation_probability: 50
+            source.updated = source_data["updated"]
+            source.current = source_data["current"]
+            source.daily = source_data["daily"]
+            source.hourly = source_data["hourly"]
+            source.stale = True
 
-        previous_value = self.extract_precipitation(daily_forecast.get("precipitation_probability", None))
-        if previous_value is None:
+        self.prune_stale_sources()
+        self.fuse(self.fused_daily, list(self.get_all_keys("daily")), "daily")
+        self.fuse(self.fused_hourly, list(self.get_all_keys("hourly")), "hourly")
+
+    def get_all_keys(self, bucket_type):
+        keys = set()
+        for source in self.sources:
+            keys.update(getattr(source, bucket_type))
+        return keys
+
+    def update_destinations(self):
+        current = fuse_buckets(
+            [CURRENT],
+            [{CURRENT: source.current} if source.current else {} for source in self.sources],
+            self.weights,
+            self.field_orders,
+            self.default_order,
+        ).get(CURRENT)
+        if current is None:
             return
 
-        value = self.extract_precipitation(forecast.get("precipitation_probability", None))
-        if value is None:
+        # Local station sensors override the current conditions of the sources
+        for field, entity in self.station.items():
+            value = get_numeric(self.get_state(entity))
+            if value is not None:
+                current[field] = value
+
+        state = current.pop("condition")
+
+        stale_sources = [source for source in self.sources if source.stale]
+        if stale_sources:
+            current["stale"] = True
+            current["stale_sources"] = [source.entity for source in stale_sources]
+            current["forecast_updated"] = min(
+                source.updated for source in stale_sources
+            )
+
+        # Bucket keys start with the date so they sort in time order
+        daily_forecast = [self.fused_daily[key] for key in sorted(self.fused_daily)]
+        hourly_forecast = [self.fused_hourly[key] for key in sorted(self.fused_hourly)]
+
+        # Use the first temperature as the temperature if it is missing
+        if "temperature" not in current:
+            first_forecast = (daily_forecast or hourly_forecast or [{}])[0]
+            current["temperature"] = first_forecast.get("temperature")
+
+        self.write_destination(
+            self.destination_entity, state, dict(current, forecast=daily_forecast)
+        )
+        if self.hourly_destination_entity:
+            self.write_destination(
+                self.hourly_destination_entity,
+                state,
+                dict(current, forecast=hourly_forecast),
+            )
+
+    def write_destination(self, entity, state, attributes):
+        # self.log(attributes)
+        if self.destination_states.get(entity) == (state, attributes):
             return
+        self.destination_states[entity] = (state, attributes)
 
-        # self.log(f'combine_precipitation {previous_value} {value}')
-        daily_forecast["precipitation_probability"] = max(
-            previous_value, value
+        self.set_state(entity, state=state, attributes=attributes, replace=True)
+
+    def get_date_string(self, period_datetime):
+        # Convert to midnight
+        date = datetime.datetime.combine(
+            period_datetime.date(), datetime.datetime.min.time()
         )
+
+        return date.astimezone().isoformat()
+
+    def get_hour_string(self, period_datetime):
+        hour = period_datetime.replace(minute=0, second=0, microsecond=0)
+
+        return hour.astimezone().isoformat()